@@ -1,22 +1,34 @@
 import json
 import logging
+import random
 import sqlite3
+import threading
 import time
+from collections import Counter
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
+from urllib.parse import urlparse
 
 import requests
 import sseclient
-import tiktoken
 from requests import Response
+from requests.adapters import HTTPAdapter
 
-from tools import load_config, cache_base, extra
+from tools import load_config, cache_base, extra, translation_memory, job_manifest
+from tools.chunk_sizer import ChunkSizer
+from tools.endpoint_pool import Endpoint, EndpointPool
+from tools.glossary_index import GlossaryIndex
+from tools.rate_limiter import RateLimiter
+from tools.stream_checker import StreamChecker
+from tools.token_counter import TokenCounter
 
 
 class OpenAITrans:
     def __init__(self, target_lang):
         load_config.configure_logging()
         self.logger = logging.getLogger(__name__)
-        self.enc = tiktoken.get_encoding("cl100k_base")
+        self.token_counter = TokenCounter("cl100k_base")
         self.target_lang = target_lang
         self.api_key = ''
         self.api_base = "https://api.openai.com"
@@ -83,6 +95,8 @@ class OpenAITrans:
         self.enable_dict_fmt = True
         self.enable_repeat_check = True
         self.glossary_dict = {}
+        self.glossary_index = GlossaryIndex()
+        self.indexed_glossary = (0, 0)
         self.context_num = 0
         self.context_all: list = []
         self.review_times = 0
@@ -93,9 +107,44 @@ class OpenAITrans:
         self.use_split_cache = True
         self.use_page_cache = False
         self.default_cache_path: str = './cache/translation.db'
-        self.conn = sqlite3.connect(self.default_cache_path)
+        self.conn = sqlite3.connect(self.default_cache_path, check_same_thread=False)
+        self.cache_writer: cache_base.CacheWriter | None = None
+        self.cache_compress = False
+        # 模糊匹配的相似度阈值，0表示不启用翻译记忆
+        self.fuzzy_threshold = 0.0
+        self.fuzzy_max_refs = 5
+        self.fuzzy_refs: dict[str, tuple[float, str, str]] = {}
+        self.cache_stats: dict[str, list[int]] = {}
+        # 断点续传：resume为True时从任务清单恢复上次中断的任务
+        self.resume = False
+        self.job_pages: dict[int, list[str]] = {}
+        # 页面译文齐全时的回调，参数为 [(页面索引, 译文)]，在翻译线程中调用，用于边翻译边写出译本
+        self.on_pages_finished: Callable[[list[tuple[int, list[str]]]], None] | None = None
         self.prompt_token_cost = 0
         self.completion_token_cost = 0
+        # 每次请求的用量记录，source为server表示服务端返回的用量，local表示本地估算
+        self.usage_records: list[dict] = []
+        self.stream_usage = True
+        # 自适应分块：按最小分块规划，运行时按ChunkSizer给出的大小合并相邻分块发送，0表示使用默认值
+        self.adaptive_chunk = False
+        self.chunk_min_tokens = 0
+        self.chunk_max_tokens = 0
+        self.chunk_sizer: ChunkSizer | None = None
+        # 译文检查失败时拆分重试，而不是整块重发
+        self.bisect_failures = True
+        # 离线模式只使用缓存，不请求API，用于导入批处理结果后生成译本
+        self.offline = False
+        self.concurrency = 1
+        self.rate_limiter = RateLimiter()
+        # 多端点配置，每项包含api_base、api_path、api_key、model、weight、concurrency、rpm、tpm，为空时只用api_url
+        self.endpoints: list[dict] = []
+        self.endpoint_pool: EndpointPool | None = None
+        self.session: requests.Session | None = None
+        self.connect_timeout = 10
+        self.stream_stall_timeout = 60
+        # 并发翻译时保护计数器、上下文和缓存连接
+        self.lock = threading.Lock()
+        self.cache_lock = threading.Lock()
 
     fallback = False
     custom_limit_tokens = 0
@@ -103,22 +152,21 @@ class OpenAITrans:
     custom_user_prompt = ""
 
     def reconnect_conn(self, cache_path):
-        self.conn = cache_base.reconnect_conn(self.conn, cache_path)
+        if self.cache_writer is not None:
+            self.cache_writer.close()
+        with self.cache_lock:
+            self.conn = cache_base.reconnect_conn(self.conn, cache_path)
+            cache_base.create_cache_table(self.conn, 'split_cache')
+            cache_base.create_cache_table(self.conn, 'page_cache')
+            cache_base.create_para_cache_table(self.conn)
+            cache_base.create_stats_table(self.conn)
+            translation_memory.create_tm_table(self.conn)
+            job_manifest.create_job_tables(self.conn)
+            if self.fuzzy_threshold > 0:
+                indexed = translation_memory.index_paras(self.conn)
+                if indexed:
+                    self.logger.info(f"Added {indexed} cached paragraphs to the translation memory index.")
         c = self.conn.cursor()
-        c.execute(f'''CREATE TABLE IF NOT EXISTS split_cache
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    target TEXT,
-                    engine TEXT,
-                    model TEXT,
-                    original TEXT,
-                    trans TEXT)''')
-        c.execute(f'''CREATE TABLE IF NOT EXISTS page_cache
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    target TEXT,
-                    engine TEXT,
-                    model TEXT,
-                    original TEXT,
-                    trans TEXT)''')
         c.execute(f'''CREATE TABLE IF NOT EXISTS failed_cache
                             (id INTEGER PRIMARY KEY AUTOINCREMENT,
                             target TEXT,
@@ -127,29 +175,133 @@ class OpenAITrans:
                             original TEXT,
                             trans TEXT,
                             time TEXT)''')
+        cache_base.add_column(self.conn, 'failed_cache', 'reason', 'TEXT')
+        cache_base.add_column(self.conn, 'failed_cache', 'depth', 'INTEGER DEFAULT 0')
+        cache_base.add_column(self.conn, 'failed_cache', 'parent', 'TEXT')
         self.conn.commit()
+        self.cache_writer = cache_base.CacheWriter(cache_path, compress=self.cache_compress,
+                                                   index_tm=self.fuzzy_threshold > 0)
 
-    def lookup_split_cache(self, original_content):
-        result = cache_base.lookup_cache(self.conn, self.target_lang, 'openai', self.custom_model, original_content,
-                                         'split_cache')
+    def flush_cache(self):
+        if self.cache_writer is not None:
+            with self.lock:
+                cache_stats, self.cache_stats = self.cache_stats, {}
+            for table_name, (lookups, hits) in cache_stats.items():
+                self.cache_writer.record_stats(table_name, lookups, hits)
+            self.cache_writer.flush()
+
+    def record_cache_use(self, table_name: str, lookups: int, hits: int, hit_ids: list[int]):
+        # 统计命中率，并刷新命中行的last_used供淘汰时参考
+        with self.lock:
+            stats = self.cache_stats.setdefault(table_name, [0, 0])
+            stats[0] += lookups
+            stats[1] += hits
+        if self.cache_writer is not None:
+            self.cache_writer.touch(table_name, hit_ids)
+
+    def lookup_cache(self, original_content, table_name):
+        if self.cache_writer is not None:
+            result = self.cache_writer.lookup_pending(self.target_lang, 'openai', self.custom_model,
+                                                      original_content, table_name)
+            if result is not None:
+                self.record_cache_use(table_name, 1, 1, [])
+                return result
+        hit_ids = []
+        with self.cache_lock:
+            result = cache_base.lookup_cache(self.conn, self.target_lang, 'openai', self.custom_model,
+                                             original_content, table_name, hit_ids)
+        self.record_cache_use(table_name, 1, len(hit_ids), hit_ids)
         return result
 
+    def write_cache(self, original_content, trans_content, table_name, allow_overwrite=False):
+        if self.cache_writer is not None:
+            self.cache_writer.write_cache(self.target_lang, 'openai', self.custom_model, original_content,
+                                          trans_content, table_name, allow_overwrite)
+        else:
+            with self.cache_lock:
+                cache_base.write_cache(self.conn, self.target_lang, 'openai', self.custom_model, original_content,
+                                       trans_content, table_name, allow_overwrite, compress=self.cache_compress)
+
+    def lookup_split_cache(self, original_content):
+        return self.lookup_cache(original_content, 'split_cache')
+
     def lookup_page_cache(self, original_content):
-        result = cache_base.lookup_cache(self.conn, self.target_lang, 'openai', self.custom_model, original_content,
-                                         'page_cache')
-        return result
+        return self.lookup_cache(original_content, 'page_cache')
 
     def write_split_cache(self, original_content, trans_content, allow_overwrite=False):
-        cache_base.write_cache(self.conn, self.target_lang, 'openai', self.custom_model, original_content,
-                               trans_content, 'split_cache', allow_overwrite)
+        self.write_cache(original_content, trans_content, 'split_cache', allow_overwrite)
 
     def write_page_cache(self, original_content, trans_content, allow_overwrite=False):
-        cache_base.write_cache(self.conn, self.target_lang, 'openai', self.custom_model, original_content,
-                               trans_content, 'page_cache', allow_overwrite)
+        self.write_cache(original_content, trans_content, 'page_cache', allow_overwrite)
 
-    def write_failed_cache(self, original_content, trans_content):
-        cache_base.write_failed_cache(self.conn, self.target_lang, 'openai', self.custom_model, original_content,
-                                      trans_content)
+    def lookup_cache_bulk(self, contents: list[list[str]], table_name: str) -> dict[int, list[str]]:
+        found = {}
+        rest_idx = []
+        for idx, content in enumerate(contents):
+            result = None
+            if self.cache_writer is not None:
+                result = self.cache_writer.lookup_pending(self.target_lang, 'openai', self.custom_model, content,
+                                                          table_name)
+            if result is not None:
+                found[idx] = result
+            else:
+                rest_idx.append(idx)
+        hit_ids = []
+        if rest_idx:
+            with self.cache_lock:
+                rest_found = cache_base.lookup_cache_bulk(self.conn, self.target_lang, 'openai', self.custom_model,
+                                                          [contents[idx] for idx in rest_idx], table_name, hit_ids)
+            for idy, trans in rest_found.items():
+                found[rest_idx[idy]] = trans
+        self.record_cache_use(table_name, len(contents), len(found), hit_ids)
+        return found
+
+    def lookup_para_cache(self, paras: list[str]) -> dict:
+        found = {}
+        if self.cache_writer is not None:
+            found = self.cache_writer.lookup_pending_paras(self.target_lang, 'openai', self.custom_model, paras)
+        rest = [para for para in paras if para not in found]
+        hit_ids = []
+        if rest:
+            with self.cache_lock:
+                found.update(cache_base.lookup_para_cache(self.conn, self.target_lang, 'openai', self.custom_model,
+                                                          rest, hit_ids))
+        self.record_cache_use('para_cache', len(set(paras)), len(found), hit_ids)
+        return found
+
+    def write_job(self, func, *args):
+        if self.cache_writer is not None:
+            self.cache_writer.submit(func, *args)
+        else:
+            with self.cache_lock:
+                func(self.conn, *args)
+
+    def lookup_fuzzy(self, paras: list[str]) -> dict[str, tuple[float, str, str]]:
+        with self.cache_lock:
+            found = translation_memory.lookup_tm(self.conn, self.target_lang, 'openai', self.custom_model, paras,
+                                                 self.fuzzy_threshold)
+        return found
+
+    def write_para_cache(self, original_content, trans_content):
+        chunk_hash = cache_base.content_hash(json.dumps(original_content, ensure_ascii=False))
+        if self.cache_writer is not None:
+            self.cache_writer.write_para_cache(self.target_lang, 'openai', self.custom_model, original_content,
+                                               trans_content, chunk_hash)
+        else:
+            with self.cache_lock:
+                cache_base.write_para_cache(self.conn, self.target_lang, 'openai', self.custom_model,
+                                            original_content, trans_content, chunk_hash,
+                                            compress=self.cache_compress)
+
+    def write_failed_cache(self, original_content, trans_content, reason='', depth=0, parent=''):
+        if self.cache_writer is not None:
+            self.cache_writer.write_failed_cache(self.target_lang, 'openai', self.custom_model, original_content,
+                                                 trans_content, reason, depth, parent)
+        else:
+            with self.cache_lock:
+                cache_base.write_failed_cache(self.conn, self.target_lang, 'openai', self.custom_model,
+                                              original_content, trans_content, reason=reason, depth=depth,
+                                              parent=parent)
 
     @staticmethod
     def is_official_model(model: str):
@@ -189,13 +341,14 @@ class OpenAITrans:
             }[model_type]
         return model, limit_tokens, time_out
 
-    def split_task(self, original_pages: list[list[str]], limit_token: int) -> list[list[str]]:
+    def chunk_limit(self, limit_token: int) -> float:
+        # 每个分块原文的token上限
         if self.use_unofficial_model:
             pass
         else:
             sys_prompt = self.gen_sys_prompt()
             user_prompt = self.gen_user_message(["This is a user message"])
-            prompt_tokens = len(self.enc.encode(sys_prompt)) + len(self.enc.encode(user_prompt))
+            prompt_tokens = sum(self.token_counter.count_batch([sys_prompt, user_prompt]))
             limit_token = (limit_token * 0.7 - prompt_tokens) / (2 * (self.context_num + 1))
 
             if self.custom_limit_tokens == 0:
@@ -205,26 +358,50 @@ class OpenAITrans:
             elif self.custom_limit_tokens > limit_token:
                 self.logger.warning('The value of custom_limit_tokens exceeds the default value.')
                 limit_token = self.custom_limit_tokens
+        return limit_token
 
+    def split_task(self, original_pages: list[list[str]], limit_token: int) -> list[list[str]]:
+        return self.split_pages(original_pages, self.chunk_limit(limit_token))
+
+    def split_pages(self, original_pages: list[list[str]], limit_token: float) -> list[list[str]]:
         result = []
         tmp_lst = []
+        # 每段只编码一次，按拼接处的增量累计 "\n".join(tmp_lst) 和 str(tmp_lst) 的token数
+        tmp_tokens = 0
+        repr_tokens = 0
+        all_para_tokens = iter(self.token_counter.count_batch([para for page in original_pages for para in page]))
         for page in original_pages:
             for para in page:
-                para_token = len(self.enc.encode(para))
+                para_token = next(all_para_tokens)
                 if para_token <= limit_token:
-                    if len(self.enc.encode("\n".join(tmp_lst + [para]))) <= limit_token:
+                    if tmp_lst:
+                        join_tokens = tmp_tokens + self.token_counter.join_cost(tmp_lst[-1], para, "\n") + para_token
+                    else:
+                        join_tokens = para_token
+                    if join_tokens <= limit_token:
+                        if self.context_num == 0:
+                            para_repr = repr(para)
+                            repr_tokens += self.token_counter.count(para_repr)
+                            if tmp_lst:
+                                repr_tokens += self.token_counter.join_cost(repr(tmp_lst[-1]), para_repr, ", ")
                         tmp_lst.append(para)
+                        tmp_tokens = join_tokens
                     else:
                         result.append(tmp_lst)
                         tmp_lst = [para]
+                        tmp_tokens = para_token
+                        if self.context_num == 0:
+                            repr_tokens = self.token_counter.count(repr(para))
                 else:
                     self.logger.error(f"One paragraph is too long, set a token limit greater than {para_token} or "
                                       f"choose to use a model that supports longer context windows.")
                     raise ValueError
 
-            if self.context_num == 0 and len(self.enc.encode(str(tmp_lst))) > limit_token / 3:
+            if self.context_num == 0 and self.count_list_str_tokens(tmp_lst, repr_tokens) > limit_token / 3:
                 result.append(tmp_lst)
                 tmp_lst = []
+                tmp_tokens = 0
+                repr_tokens = 0
         # If tmp_lst not empty
         if len(tmp_lst) > 0:
             result.append(tmp_lst)
@@ -232,23 +409,37 @@ class OpenAITrans:
                          f"requests.")
         return result
 
-    def restore_task(self, origin_contents: list[list[str]], translated_contents: list[list[str]]) -> list[list[str]]:
+    def count_list_str_tokens(self, lst: list[str], items_tokens: int) -> int:
+        # str(lst) 的token数：元素repr以 ", " 拼接的部分加上首尾的方括号
+        if not lst:
+            return self.token_counter.count("[]")
+        counter = self.token_counter
+        return (items_tokens + counter.count("[") + counter.count("]") +
+                counter.join_cost("[", repr(lst[0]), "") + counter.join_cost(repr(lst[-1]), "]", ""))
+
+    def restore_task(self, origin_contents: list[list[str]], translated_contents: list[list[str]],
+                     cached_paras: dict | None = None) -> list[list[str]]:
+        # cached_paras中的段落命中了段落缓存，没有参与分块翻译
+        cached_paras = cached_paras or {}
         restored_contents = []
         tmp_page = []
         para_miss = 0
         split_trans_pgs = iter([translated_page for translated_page in translated_contents])
         for page_index, page in enumerate(origin_contents):
-            while len(tmp_page) < len(page):
+            need_num = len([para for para in page if para not in cached_paras])
+            while len(tmp_page) < need_num:
                 try:
                     translated_page = next(split_trans_pgs)
                 except StopIteration:
-                    para_miss += (len(page) - len(tmp_page))
+                    para_miss += (need_num - len(tmp_page))
                     self.logger.error(f"Not enough translated content for page {page_index}.")
                     translated_page = [f"Not enough translated content for page {page_index}."] * (
-                            len(page) - len(tmp_page))
+                            need_num - len(tmp_page))
                 tmp_page += translated_page
-            restored_contents.append(tmp_page[:len(page)])
-            tmp_page = tmp_page[len(page):]
+            page_trans = iter(tmp_page[:need_num])
+            restored_contents.append([cached_paras[para] if para in cached_paras else next(page_trans)
+                                      for para in page])
+            tmp_page = tmp_page[need_num:]
             # 写入整页缓存
             if para_miss == 0:
                 same_para = 0
@@ -301,15 +492,40 @@ class OpenAITrans:
             fin_glossary = ["The glossary includes:"]
         else:
             fin_glossary = ["## Glossary:"]
-        content = str(origin_content)
-        for term, trans in formatted_glossary.items():
-            if term in content:
-                fin_glossary.append(trans)
+        # 术语表有新增时只把新术语插入索引
+        glossary_state = (id(formatted_glossary), len(formatted_glossary))
+        with self.glossary_index.lock:
+            if glossary_state != self.indexed_glossary:
+                self.glossary_index.update(formatted_glossary.keys())
+                self.indexed_glossary = glossary_state
+        for term in self.glossary_index.find(str(origin_content)):
+            if term in formatted_glossary:
+                fin_glossary.append(formatted_glossary[term])
         if len(fin_glossary) > 1:
             return "\n".join(fin_glossary)
         else:
             return ""
 
+    def select_references(self, origin_content: list[str]):
+        # 相似段落的已有译文作为参考
+        refs = [self.fuzzy_refs[para] for para in origin_content if para in self.fuzzy_refs]
+        if not refs:
+            return ""
+        refs = sorted(refs, key=lambda ref: ref[0], reverse=True)[:self.fuzzy_max_refs]
+        if (not self.custom_sys_prompt or "## " not in self.custom_sys_prompt) and (
+                self.custom_sys_prompt or not self.enable_stream):
+            fin_refs = ["Some paragraphs are similar to ones translated before, keep consistent with these "
+                        "translations:"]
+        else:
+            fin_refs = ["## Reference Translations:"]
+        for score, original, trans in refs:
+            fin_refs.append(f'- "{original}" translates to "{trans}"')
+        return "\n".join(fin_refs)
+
+    def gen_glossary(self, origin_content: list[str]):
+        return "\n\n".join(part for part in (self.select_glossary(self.glossary_dict, origin_content),
+                                             self.select_references(origin_content)) if part)
+
     def gen_sys_prompt(self, glossary=""):
         if self.custom_sys_prompt != "":
             prompt_tp = self.custom_sys_prompt
@@ -356,6 +572,47 @@ class OpenAITrans:
             msg = template.substitute(trans_text=trans_text)
         return msg
 
+    def gen_payload(self, origin_content: list[str], model: str) -> dict:
+        fin_glossary = self.gen_glossary(origin_content)
+        if fin_glossary:
+            self.logger.info(f'Glossary: \n{fin_glossary}')
+        sys_prompt = self.gen_sys_prompt(fin_glossary)
+        user_msg = self.gen_user_message(origin_content)
+        self.logger.info(f"The original totals {len(origin_content)} lines.")
+
+        if self.enable_stream and not self.enable_dict_fmt:
+            presence_penalty = 0.2
+            frequency_penalty = 0.4
+        else:
+            presence_penalty = 0.1
+            frequency_penalty = 0.2
+
+        messages = [{"role": "system", "content": sys_prompt}]
+        if self.context_num > 0 and len(self.context_all) > 0:
+            if self.context_num <= len(self.context_all):
+                last_contexts = self.context_all[-self.context_num:]
+            else:
+                last_contexts = self.context_all.copy()
+            for context in last_contexts:
+                messages.append({"role": "user", "content": self.gen_user_message(context[0])})
+                messages.append({"role": "assistant", "content": self.gen_assistant_message(context[1])})
+            self.logger.info(f'Added {len(last_contexts)} contexts into messages.')
+        messages.append({"role": "user", "content": user_msg})
+
+        payload = {
+            "model": model,
+            "messages": messages,
+            "top_p": 1,
+            "temperature": 0.6,
+            "presence_penalty": presence_penalty,
+            "frequency_penalty": frequency_penalty,
+            "stream": self.enable_stream
+        }
+        if self.enable_stream and self.stream_usage:
+            # 让服务端在最后一个数据块中返回用量
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
     def parse_result_msg(self, result_msg: str) -> dict:
         result = {}
         result_msg = result_msg.strip()
@@ -402,7 +659,7 @@ class OpenAITrans:
             if source_rp != trans_rp:
                 self.logger.error(
                     f"There may be unnecessary repeat or missing in the translation: {source_rp} - {trans_rp}")
-                raise ValueError
+                raise ValueError(f"Repeat mismatch: {source_rp} - {trans_rp}")
         # 检查译文是否有缺失
         miss_count = []
         for i, para in enumerate(origin_content):
@@ -414,110 +671,138 @@ class OpenAITrans:
             self.logger.error(
                 "The number of missing content exceeds the tolerance value, and the missing rows are: " + ", ".join(
                     miss_count))
-            raise ValueError
+            raise ValueError(f"Missing paragraphs: {', '.join(miss_count)}")
         elif len(miss_count) == 1:
             self.logger.warning(f"The translation on line {miss_count[0]} is missing, filled with its original.")
 
         # 检查译文是否比原文行数多了
         if len(translated_content.values()) > len(origin_content):
             self.logger.error("The translation may contain content that was not in the original.")
-            raise ValueError
+            raise ValueError("Extra paragraphs")
 
         return translated_content
 
-    def translate(self, origin_content: list[str], url: str, key: str, model: str, time_out: int,
-                  max_err: int = 3) -> list[str]:
+    def translate(self, origin_content: list[str], model: str, time_out: int, max_err: int = 3,
+                  use_cache: bool = True, count_failure: bool = True, depth: int = 0, parent: str = '') -> list[str]:
+        return self.request_translation(origin_content, model, time_out, max_err, use_cache, count_failure, depth,
+                                        parent)[0]
+
+    def request_translation(self, origin_content: list[str], model: str, time_out: int, max_err: int = 3,
+                            use_cache: bool = True, count_failure: bool = True, depth: int = 0,
+                            parent: str = '') -> tuple[list[str], bool]:
+        # 返回 (译文, 是否全部翻译成功)；拆分重试后仍有段落失败时，译文中这些段落保持原文
         if origin_content:
             pass
         else:
-            return []
-        if self.use_split_cache:
+            return [], True
+        if self.use_split_cache and use_cache:
             cache_translated = self.lookup_split_cache(origin_content)
             if cache_translated:
                 self.logger.info("Hit translation cache, use cache as result.")
-                self.context_all.append([origin_content, cache_translated])
-                return cache_translated
-
-        self.logger.info("Do not allow use cached results or no cache hit, start the translation request.")
-        fin_glossary = self.select_glossary(self.glossary_dict, origin_content)
-        if fin_glossary:
-            self.logger.info(f'Glossary: \n{fin_glossary}')
-        sys_prompt = self.gen_sys_prompt(fin_glossary)
-        user_msg = self.gen_user_message(origin_content)
-        self.logger.info(f"The original totals {len(origin_content)} lines.")
+                with self.lock:
+                    self.context_all.append([origin_content, cache_translated])
+                return cache_translated, True
 
-        if self.enable_stream and not self.enable_dict_fmt:
-            presence_penalty = 0.2
-            frequency_penalty = 0.4
-        else:
-            presence_penalty = 0.1
-            frequency_penalty = 0.2
+        if self.offline:
+            self.logger.warning(f"No batch result for {len(origin_content)} paragraphs, keep the original.")
+            if count_failure:
+                with self.lock:
+                    self.failed += 1
+            return origin_content, False
 
-        messages = [{"role": "system", "content": sys_prompt}]
-        if self.context_num > 0 and len(self.context_all) > 0:
-            if self.context_num <= len(self.context_all):
-                last_contexts = self.context_all[-self.context_num:]
-            else:
-                last_contexts = self.context_all.copy()
-            for context in last_contexts:
-                messages.append({"role": "user", "content": self.gen_user_message(context[0])})
-                messages.append({"role": "assistant", "content": self.gen_assistant_message(context[1])})
-            self.logger.info(f'Added {len(last_contexts)} contexts into messages.')
-        messages.append({"role": "user", "content": user_msg})
-
-        payload = {
-            "model": model,
-            "messages": messages,
-            "top_p": 1,
-            "temperature": 0.6,
-            "presence_penalty": presence_penalty,
-            "frequency_penalty": frequency_penalty,
-            "stream": self.enable_stream
-        }
+        self.logger.info("Do not allow use cached results or no cache hit, start the translation request.")
+        payload = self.gen_payload(origin_content, model)
+        messages = payload["messages"]
+        user_msg = messages[-1]["content"]
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f'Bearer {key}'
-        }
+        # 预留本次请求的token：提示词加上与原文相当的译文
+        reserved_tokens = sum(self.token_counter.count_batch([m['content'] for m in messages] + [user_msg]))
         err_count = 0
+        response: Response | None = None
+        pool = self.get_endpoint_pool()
+        # 这个分块失败过的端点，重试时优先换到其它端点
+        failed_endpoints = set()
         while err_count < max_err:
+            endpoint: Endpoint | None = None
+            endpoint_status = 'ok'
+            bisect_content = None
             try:
                 finish_reason = ''
+                completion_num = 0
+                parsed_content = None
+                endpoint = pool.acquire(failed_endpoints)
+                url = endpoint.url
+                payload["model"] = endpoint.model or model
+                headers = {
+                    "Content-Type": "application/json",
+                    "Authorization": f'Bearer {endpoint.key}'
+                }
+                endpoint.rate_limiter.acquire(reserved_tokens)
+                request_start = time.time()
                 if self.enable_stream:
                     self.logger.info("Start to stream requesst.")
                     collected_messages = []
-                    response: Response = requests.post(url, data=json.dumps(payload), headers=headers, stream=True)
+                    # 读超时对流式响应按每次读取计算，相当于流停滞超时
+                    response = self.get_session().post(url, data=json.dumps(payload), headers=headers, stream=True,
+                                                       timeout=(self.connect_timeout, self.stream_stall_timeout))
+                    endpoint.rate_limiter.update_from_headers(response.headers)
+                    if response.status_code != 200:
+                        endpoint_status = self.handle_http_error(response, err_count, reserved_tokens, endpoint)
+                        err_count += 1
+                        continue
                     client = sseclient.SSEClient(response)
+                    checker = StreamChecker(origin_content, self.enable_dict_fmt, self.enable_repeat_check)
+                    usage = None
                     for event in client.events():
                         if event.data != '[DONE]':
                             chunk_data = json.loads(event.data)
+                            if chunk_data.get('usage'):
+                                usage = chunk_data['usage']
+                            if not chunk_data.get('choices'):
+                                continue
                             chunk_message = chunk_data['choices'][0]['delta']
                             collected_messages.append(chunk_message)
                             if chunk_data['choices'][0]['finish_reason'] is not None:
                                 finish_reason = chunk_data['choices'][0]['finish_reason']
+                            # 已经确定失败的响应不再等它生成完，关闭连接后重试
+                            if chunk_message.get('content') and not checker.feed(chunk_message['content']):
+                                full_content = ''.join([m.get('content', '') for m in collected_messages])
+                                self.logger.warning(f"Abort the stream early after {len(full_content)} characters.")
+                                parsed_content = checker.parsed()
+                                self.record_usage(endpoint, origin_content, reserved_tokens,
+                                                  *self.count_usage(messages, full_content), 'local')
+                                raise ValueError(checker.error)
                     full_content = ''.join([m.get('content', '') for m in collected_messages])
-                    prompt_num = len(self.enc.encode(json.dumps(messages, ensure_ascii=False)))
-                    completion_num = len(self.enc.encode(full_content))
-                    total_num = prompt_num + completion_num
+                    if usage:
+                        completion_num = self.record_usage(endpoint, origin_content, reserved_tokens,
+                                                            usage['prompt_tokens'], usage['completion_tokens'],
+                                                            'server')
+                    else:
+                        # 服务端不支持返回流式用量时才在本地计算
+                        completion_num = self.record_usage(endpoint, origin_content, reserved_tokens,
+                                                           *self.count_usage(messages, full_content), 'local')
                 else:
-                    response: Response = requests.post(url, data=json.dumps(payload), headers=headers, timeout=time_out)
+                    response = self.get_session().post(url, data=json.dumps(payload), headers=headers,
+                                                       timeout=(self.connect_timeout, time_out))
+                    endpoint.rate_limiter.update_from_headers(response.headers)
+                    if response.status_code != 200:
+                        endpoint_status = self.handle_http_error(response, err_count, reserved_tokens, endpoint)
+                        err_count += 1
+                        continue
                     res = response.json()
                     finish_reason = res['choices'][0]['finish_reason']
                     full_content: str | dict = res['choices'][0]['message']['content']
-                    total_num = res['usage']['total_tokens']
-                    prompt_num = res['usage']['prompt_tokens']
-                    completion_num = res['usage']['completion_tokens']
+                    completion_num = self.record_usage(endpoint, origin_content, reserved_tokens,
+                                                       res['usage']['prompt_tokens'],
+                                                       res['usage']['completion_tokens'], 'server')
 
                 if finish_reason == "stop":
                     pass
                 elif finish_reason == "length":
                     self.logger.error(
                         f"The max_tokens limit has been reached, please set a smaller limit_tokens value.")
-                    return origin_content
-                if total_num:
-                    self.logger.info(f"Total tokens cost: {total_num}")
-                    self.prompt_token_cost += prompt_num
-                    self.completion_token_cost += completion_num
+                    self.observe_chunk(origin_content, completion_num, request_start, 'length')
+                    return origin_content, False
                 if isinstance(full_content, str):
                     translated_content = self.parse_result_msg(full_content)
                 elif isinstance(full_content, dict):
@@ -526,7 +811,9 @@ class OpenAITrans:
                     self.logger.error(f"Can not parse type of content: \n{full_content}")
                     raise TypeError
 
+                parsed_content = dict(translated_content)
                 translated_content = self.check_translation(origin_content, translated_content)
+                self.observe_chunk(origin_content, completion_num, request_start, 'ok')
                 translated = list(translated_content.values())
                 self.logger.info(f"The translation totals {len(translated)} lines.")
                 # 成功翻译，审查并缓存后返回结果
@@ -540,108 +827,561 @@ class OpenAITrans:
                             translated = extra.edit_trans(origin_content, translated)
                 self.review_times -= 1
                 self.write_split_cache(origin_content, translated)
+                self.write_para_cache(origin_content, translated)
                 self.logger.info(f"The translation was successful with errors {err_count} times.\n")
-                self.context_all.append([origin_content, translated])
-                return translated
-            except requests.exceptions.Timeout:
-                self.logger.error(f"Translate request to f{url} timeout\n")
+                with self.lock:
+                    self.context_all.append([origin_content, translated])
+                return translated, True
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                endpoint_status = 'fail'
+                self.logger.error(f"Translate request to {url} timeout or the stream stalled: {e}\n")
+                time.sleep(RateLimiter.backoff_time(err_count))
             except requests.exceptions.JSONDecodeError:
+                endpoint_status = 'fail'
                 self.logger.error(f'Failed to decode response, status code: {response.status_code}')
                 self.logger.debug(f'Response: \n{response.text}\n')
-                if response.status_code == 429:
-                    sleep_time = (err_count + 1) ** 2 * 60.0
-                    self.logger.warning(f"Reached rate limit, try sleep {sleep_time} seconds\n")
-                    time.sleep(sleep_time)
-                elif response.status_code == 403:
-                    self.logger.error("You seem to be blocked from accessing this API address\n")
-                    raise requests.exceptions.HTTPError
-                elif response.status_code == 502 or 500 or 524:
-                    self.logger.error("The server seems to have encountered an error internally, wait 30s\n")
-                    time.sleep(30.0)
-                elif response.status_code == 401:
-                    self.logger.error("Authentication failed, you may be using an invalid API key.")
-                    raise requests.exceptions.HTTPError
+                time.sleep(RateLimiter.backoff_time(err_count))
+            except requests.exceptions.HTTPError:
+                raise
             except ValueError as e:
                 self.logger.error(f"Translation check failed: {e}")
-                try:
-                    self.write_failed_cache(origin_content, translated_content)
-                except UnboundLocalError:
-                    pass
+                self.observe_chunk(origin_content, completion_num, request_start, 'invalid')
+                self.write_failed_cache(origin_content, parsed_content or {}, str(e), depth, parent)
+                # 不再整块重试，保留通过检查的段落，其余部分拆小后重试
+                if self.bisect_failures and len(origin_content) > 1:
+                    bisect_content = parsed_content or {}
             except Exception as e:
+                endpoint_status = 'fail'
                 self.logger.error(f"Other error: {e}")
                 continue
+            finally:
+                # 释放连接回连接池
+                if response is not None:
+                    response.close()
+                if endpoint is not None:
+                    pool.release(endpoint, endpoint_status)
+                    if endpoint_status != 'ok':
+                        failed_endpoints.add(endpoint.name)
+                    if endpoint_status == 'fatal' and pool.all_disabled():
+                        raise requests.exceptions.HTTPError("All API endpoints are disabled.")
+            # 释放端点后再拆分重试，否则子请求要等待本次请求占用的并发名额
+            if bisect_content is not None:
+                return self.bisect_translate(origin_content, bisect_content, model, time_out, max_err, depth)
 
             err_count += 1
 
         self.logger.error("Exceeded max retry count, giving up. \n")
-        self.failed += 1
+        if count_failure:
+            with self.lock:
+                self.failed += 1
         self.logger.debug(f"Original: {origin_content}")
-        return origin_content
+        return origin_content, False
 
-    def start_task(self, origin_contents: list[list[str]]):
+    def count_usage(self, messages: list[dict], full_content: str) -> tuple[int, int]:
+        # 逐条消息计数，系统提示词和上下文的计数会命中缓存；每条消息另有3个格式token，回复前缀3个
+        prompt_num = sum(self.token_counter.count_batch([m['content'] for m in messages])) + 3 * len(messages) + 3
+        return prompt_num, self.token_counter.count(full_content)
+
+    def record_usage(self, endpoint: Endpoint, origin_content: list[str], reserved_tokens: int, prompt_num: int,
+                     completion_num: int, source: str):
+        total_num = prompt_num + completion_num
+        endpoint.rate_limiter.settle(reserved_tokens, total_num)
+        self.logger.info(f"Total tokens cost: {total_num}")
+        with self.lock:
+            self.prompt_token_cost += prompt_num
+            self.completion_token_cost += completion_num
+            self.usage_records.append({"endpoint": endpoint.name, "url": endpoint.url, "paras": len(origin_content),
+                                       "prompt": prompt_num, "completion": completion_num, "source": source})
+        return completion_num
+
+    def log_usage(self):
+        self.logger.info(f"Total prompt tokens cost in task: {self.prompt_token_cost}")
+        self.logger.info(f"Total completion tokens cost in task: {self.completion_token_cost}")
+        for source, (requests_num, prompt_num, completion_num) in self.usage_summary().items():
+            self.logger.info(f"Usage from {source}: {requests_num} requests, {prompt_num} prompt, "
+                             f"{completion_num} completion tokens")
+        if len(self.endpoints) > 1:
+            for name, (requests_num, prompt_num, completion_num) in self.usage_summary("endpoint").items():
+                self.logger.info(f"Usage of endpoint {name}: {requests_num} requests, {prompt_num} prompt, "
+                                 f"{completion_num} completion tokens")
+
+    def observe_chunk(self, origin_content: list[str], completion_num: int, request_start: float, status: str):
+        if self.chunk_sizer is not None:
+            source_tokens = sum(self.token_counter.count_batch(origin_content))
+            self.chunk_sizer.observe(source_tokens, completion_num, time.time() - request_start, status)
+
+    def usage_summary(self, key: str = "source") -> dict[str, list[int]]:
+        # 按指定字段汇总用量记录 {值: [请求数, 提示词token, 补全token]}
+        summary = {}
+        with self.lock:
+            for record in self.usage_records:
+                item = summary.setdefault(record[key], [0, 0, 0])
+                item[0] += 1
+                item[1] += record["prompt"]
+                item[2] += record["completion"]
+        return summary
+
+    def salvage_translation(self, origin_content: list[str], parsed_content: dict) -> dict[int, str]:
+        # 检查失败的译文中仍然可信的段落 {索引: 译文}
+        # 段落有缺失或多出时，模型可能合并或拆分了段落，之后的编号整体错位，无法确定每段对应哪个原文
+        if set(parsed_content) != {str(idx + 1) for idx in range(len(origin_content))}:
+            return {}
+        orig_count = Counter(origin_content)
+        trans_count = Counter(trans for trans in parsed_content.values() if isinstance(trans, str))
+        salvaged = {}
+        for idx, para in enumerate(origin_content):
+            trans = parsed_content.get(str(idx + 1))
+            if not isinstance(trans, str) or not trans.strip():
+                continue
+            # 比原文多出来的重复说明译文错位或复读
+            if trans_count[trans] > orig_count[para]:
+                continue
+            salvaged[idx] = trans
+        return salvaged
+
+    def bisect_translate(self, origin_content: list[str], parsed_content: dict, model: str, time_out: int,
+                         max_err: int, depth: int) -> tuple[list[str], bool]:
+        # 保留通过检查的段落，其余部分对半拆分后重试，递归直到单个段落
+        salvaged = self.salvage_translation(origin_content, parsed_content)
+        failing = [idx for idx in range(len(origin_content)) if idx not in salvaged]
+        parts = [part for part in (failing[:len(failing) // 2], failing[len(failing) // 2:]) if part]
+        self.logger.warning(f"Keep {len(salvaged)} checked paragraphs and retry the other {len(failing)} "
+                            f"in {len(parts)} parts.")
+        if salvaged:
+            self.write_para_cache([origin_content[idx] for idx in salvaged], list(salvaged.values()))
+        parent = cache_base.content_hash(json.dumps(origin_content, ensure_ascii=False))
+        translated = dict(salvaged)
+        finished = True
+        for part in parts:
+            part_content = [origin_content[idx] for idx in part]
+            part_trans, part_finished = self.request_translation(part_content, model, time_out, max_err=max_err,
+                                                                 use_cache=False, depth=depth + 1, parent=parent)
+            finished = finished and part_finished
+            translated.update(zip(part, part_trans))
+        translated = [translated[idx] for idx in range(len(origin_content))]
+        # 有段落最终失败时不写入分块缓存，下次运行时重新翻译
+        if finished:
+            self.write_split_cache(origin_content, translated)
+        return translated, finished
+
+    def get_endpoint_pool(self) -> EndpointPool:
+        # 没有配置多端点时，用api_url、api_key和全局限流器组成唯一的端点
+        with self.lock:
+            if self.endpoint_pool is None:
+                if self.endpoints:
+                    endpoints = [Endpoint(conf.get('name') or f"endpoint-{idx + 1}",
+                                          conf.get('api_base', self.api_base) + conf.get('api_path', self.api_path),
+                                          conf.get('api_key', self.api_key), conf.get('model', ''),
+                                          conf.get('weight', 1.0), conf.get('concurrency', 1),
+                                          RateLimiter(conf.get('rpm', 0), conf.get('tpm', 0)))
+                                 for idx, conf in enumerate(self.endpoints)]
+                else:
+                    endpoints = [Endpoint('default', self.api_url, self.api_key, '', 1.0, max(1, self.concurrency),
+                                          self.rate_limiter)]
+                self.endpoint_pool = EndpointPool(endpoints)
+        return self.endpoint_pool
+
+    def get_session(self) -> requests.Session:
+        # 复用长连接，每个端点主机一个连接池，连接池大小与并发数一致
+        hosts = {urlparse(endpoint.get('api_base', self.api_base))[:2] for endpoint in self.endpoints}
+        with self.lock:
+            if self.session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=max(1, len(hosts)), pool_maxsize=max(1, self.concurrency),
+                                      pool_block=True)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update({"Connection": "keep-alive"})
+                self.session = session
+        return self.session
+
+    def handle_http_error(self, response: Response, err_count: int, reserved_tokens: int, endpoint: Endpoint) -> str:
+        # 返回端点的状态，供熔断判断
+        self.logger.error(f'Request to {endpoint.name} failed, status code: {response.status_code}')
+        self.logger.debug(f'Response: \n{response.text}\n')
+        rate_limiter = endpoint.rate_limiter
+        # 被拒绝的请求不计入额度
+        rate_limiter.settle(reserved_tokens, 0)
+        if response.status_code == 429:
+            sleep_time = rate_limiter.parse_retry_after(response.headers)
+            sleep_time = sleep_time + random.uniform(0, 1) if sleep_time else rate_limiter.backoff_time(err_count)
+            self.logger.warning(f"Reached rate limit, pause requests for {sleep_time:.1f} seconds\n")
+            rate_limiter.penalize(sleep_time)
+            return 'busy'
+        elif response.status_code in (401, 403):
+            if response.status_code == 403:
+                self.logger.error("You seem to be blocked from accessing this API address\n")
+            else:
+                self.logger.error("Authentication failed, you may be using an invalid API key.")
+            # 其它端点还能用时只停用这一个
+            return 'fatal'
+        else:
+            sleep_time = rate_limiter.parse_retry_after(response.headers) or rate_limiter.backoff_time(err_count)
+            # 有其它可用端点时不必等待，直接换端点重试
+            if len(self.get_endpoint_pool().endpoints) == 1:
+                self.logger.error(f"The server seems to have encountered an error, wait {sleep_time:.1f}s\n")
+                time.sleep(sleep_time)
+            return 'fail'
+
+    def plan_task(self, origin_contents: list[list[str]]) -> dict:
+        # 先批量查询各级缓存，确定哪些页面和分块真正需要请求API
         model_name, limit_tokens, time_out = self.judge_model(self.custom_model)
+        self.token_counter.set_model(model_name)
         self.logger.info(f"Selected model: {model_name}")
-        key = self.api_key
-
-        cached_pgs_idx = []
-        cached_pgs_trans = []
-        no_cache_pgs_idx = []
-        no_cache_pgs_orig = []
-        for idx, pg in enumerate(origin_contents):
-            lk = self.lookup_page_cache(pg)
-            if self.use_page_cache and lk:
-                cached_pgs_idx.append(idx)
-                cached_pgs_trans.append(lk)
-            else:
-                no_cache_pgs_idx.append(idx)
-                no_cache_pgs_orig.append(pg)
+
+        cached_pgs = {}
         if self.use_page_cache:
-            self.logger.info(f"{len(cached_pgs_idx)} pages hit cache")
+            cached_pgs = self.lookup_cache_bulk(origin_contents, 'page_cache')
+            self.logger.info(f"{len(cached_pgs)} pages hit cache")
+        no_cache_pgs_idx = [idx for idx in range(len(origin_contents)) if idx not in cached_pgs]
+        no_cache_pgs_orig = [origin_contents[idx] for idx in no_cache_pgs_idx]
+
+        # 命中段落缓存的段落不再参与分块，分块边界变化也不会让已有译文失效
+        cached_paras = {}
+        if self.use_split_cache:
+            cached_paras = self.lookup_para_cache([para for pg in no_cache_pgs_orig for para in pg])
+            self.logger.info(f"{len(cached_paras)} paragraphs hit paragraph cache")
+        # 近似重复的段落：只有标点空白差异的直接复用，其余作为参考译文放进提示词
+        if self.use_split_cache and self.fuzzy_threshold > 0:
+            fuzzy = self.lookup_fuzzy([para for pg in no_cache_pgs_orig for para in pg if para not in cached_paras])
+            reused = {para: match[2] for para, match in fuzzy.items() if match[0] >= 1.0}
+            cached_paras.update(reused)
+            self.fuzzy_refs = {para: match for para, match in fuzzy.items() if match[0] < 1.0}
+            self.logger.info(f"{len(reused)} paragraphs reused and {len(self.fuzzy_refs)} paragraphs got reference "
+                             f"translations from translation memory")
+        uncached_pgs = [[para for para in pg if para not in cached_paras] for pg in no_cache_pgs_orig]
+
+        chunk_tokens = None
+        if not any(uncached_pgs):
+            # 全部命中缓存时不需要分块，也不必为计算提示词长度加载编码器
+            spilt_contents = []
+        elif self.adaptive_chunk:
+            chunk_limit = self.chunk_limit(limit_tokens)
+            chunk_tokens = [self.chunk_min_tokens or chunk_limit / 4, self.chunk_max_tokens or chunk_limit,
+                            chunk_limit]
+            # 最小分块不能小于最长的段落
+            longest = max(self.token_counter.count_batch([para for pg in uncached_pgs for para in pg]), default=0)
+            chunk_tokens[0] = min(max(chunk_tokens[0], longest), chunk_limit)
+            self.logger.info(f"Adaptive chunk size between {chunk_tokens[0]:.0f} and {chunk_tokens[1]:.0f} tokens.")
+            spilt_contents = self.split_pages(uncached_pgs, chunk_tokens[0])
+        else:
+            spilt_contents = self.split_task(uncached_pgs, limit_tokens)
+        cached_splits = {}
+        if self.use_split_cache:
+            cached_splits = self.lookup_cache_bulk(spilt_contents, 'split_cache')
+        need_pgs = len([pg for pg in uncached_pgs if pg])
+        self.logger.info(f"{need_pgs}/{len(origin_contents)} pages and "
+                         f"{len(spilt_contents) - len(cached_splits)}/{len(spilt_contents)} split tasks need to be "
+                         f"requested.")
+        return {
+            "model": model_name,
+            "limit_tokens": limit_tokens,
+            "time_out": time_out,
+            "cached_pgs": cached_pgs,
+            "no_cache_pgs_idx": no_cache_pgs_idx,
+            "no_cache_pgs_orig": no_cache_pgs_orig,
+            "cached_paras": cached_paras,
+            "spilt_contents": spilt_contents,
+            "cached_splits": cached_splits,
+            "fuzzy_refs": self.fuzzy_refs,
+            "chunk_tokens": chunk_tokens
+        }
+
+    def load_plan(self, origin_contents: list[list[str]]) -> tuple[str, dict, dict[int, list[str]]]:
+        # 同一内容、目标语言和模型的任务共用一个清单
+        job_id = cache_base.content_hash(json.dumps([self.target_lang, self.custom_model, origin_contents],
+                                                    ensure_ascii=False))
+        if self.resume:
+            with self.cache_lock:
+                job = job_manifest.load_job(self.conn, job_id)
+            if job is not None:
+                plan, done_chunks = job
+                self.token_counter.set_model(plan["model"])
+                self.fuzzy_refs = plan["fuzzy_refs"]
+                self.logger.info(f"Resume the interrupted task, {len(done_chunks)}/{len(plan['spilt_contents'])} "
+                                 f"split tasks were finished.")
+                return job_id, plan, done_chunks
+            self.logger.info("No interrupted task to resume, start a new task.")
+        plan = self.plan_task(origin_contents)
+        self.write_job(job_manifest.save_job, job_id, plan)
+        return job_id, plan, {}
+
+    def start_task(self, origin_contents: list[list[str]]):
+        job_id, plan, done_chunks = self.load_plan(origin_contents)
+        failed_before = self.failed
+        model_name = plan["model"]
+        time_out = plan["time_out"]
+        spilt_contents = plan["spilt_contents"]
+        cached_splits = plan["cached_splits"]
+        done_chunks.update(cached_splits)
+        task_total = len(spilt_contents)
+        task_left = [task_total]
+
+        # 记录每个页面的完成情况，页面译文齐全后立即写入任务清单
+        progress = job_manifest.JobProgress(plan["no_cache_pgs_orig"], plan["cached_paras"], spilt_contents)
+        self.job_pages = dict(plan["cached_pgs"])
+        if self.on_pages_finished and plan["cached_pgs"]:
+            self.on_pages_finished(list(plan["cached_pgs"].items()))
+
+        def record_pages(finished_pages: list[tuple[int, list[str]]]):
+            for pg_idx, page_trans in finished_pages:
+                idx = plan["no_cache_pgs_idx"][pg_idx]
+                with self.lock:
+                    self.job_pages[idx] = page_trans
+                self.write_job(job_manifest.save_page, job_id, idx, page_trans)
+            if self.on_pages_finished and finished_pages:
+                self.on_pages_finished([(plan["no_cache_pgs_idx"][pg_idx], page_trans)
+                                        for pg_idx, page_trans in finished_pages])
 
-        spilt_contents = self.split_task(no_cache_pgs_orig, limit_tokens)
-        translated_contents = []
-        task_num = len(spilt_contents)
-        for content in spilt_contents:
+        # 已完成分块凑齐的页面由add_chunk返回，不需要分块的页面由collect_finished返回
+        finished_pages = []
+        for task_idx, trans in done_chunks.items():
+            finished_pages.extend(progress.add_chunk(task_idx, trans))
+        record_pages(finished_pages + progress.collect_finished())
+
+        def run_tasks(task_idxs: list[int], final: bool = True) -> list[list[str]] | None:
+            # 相邻的多个分块可以合并成一次请求，译文再按分块拆开；final为False时失败返回None，由调用方拆小重试
+            if len(task_idxs) == 1 and task_idxs[0] in done_chunks:
+                self.logger.info("Hit translation cache, use cache as result.")
+                with self.lock:
+                    self.context_all.append([spilt_contents[task_idxs[0]], done_chunks[task_idxs[0]]])
+                    task_left[0] -= 1
+                return [done_chunks[task_idxs[0]]]
+            content = [para for task_idx in task_idxs for para in spilt_contents[task_idx]]
             start_time = time.time()
-            self.logger.info(f"Total split tasks left: {task_num}/{len(spilt_contents)}")
-            translated = self.translate(content, self.api_url, key, model_name, time_out, max_err=self.max_err)
-            if isinstance(translated, list):
-                translated_contents.append(translated)
-            else:
+            translated, finished = self.request_translation(content, model_name, time_out, max_err=self.max_err,
+                                                            use_cache=False, count_failure=final)
+            if not isinstance(translated, list):
                 self.logger.error("Unknown type error")
-                translated_contents.append(content)
-            task_num -= 1
+                translated = content
+                finished = False
+            if translated is content and not final:
+                return None
+            results = []
+            pos = 0
+            for task_idx in task_idxs:
+                task_content = spilt_contents[task_idx]
+                # 翻译失败时translate原样返回原文列表，这样的分块续传时要重新翻译
+                if translated is content:
+                    results.append(task_content)
+                    continue
+                task_trans = translated[pos:pos + len(task_content)]
+                pos += len(task_content)
+                results.append(task_trans)
+                # 拆分重试后仍有段落失败的分块不记入清单，续传时重新翻译，已成功的段落会命中段落缓存
+                if not finished:
+                    continue
+                self.write_job(job_manifest.save_chunk, job_id, task_idx, task_trans)
+                record_pages(progress.add_chunk(task_idx, task_trans))
             end_time = time.time()
+            with self.lock:
+                task_left[0] -= len(task_idxs)
+                self.logger.info(f"Total split tasks left: {task_left[0]}/{task_total}")
             self.logger.info(f"The last split task took time: {float(end_time - start_time)}")
+            return results
+
+        def run_split_task(task_idx: int) -> list[str]:
+            return run_tasks([task_idx])[0]
+
+        chunk_tokens = plan.get("chunk_tokens")
+        self.chunk_sizer = ChunkSizer(*chunk_tokens) if chunk_tokens else None
+        task_tokens = [sum(self.token_counter.count_batch(content)) for content in spilt_contents] \
+            if self.chunk_sizer else []
+        # cursor[0]是下一个待分配的分块，cursor[1]为True时不再分配新的请求
+        cursor = [0, False]
+
+        def next_group() -> list[int]:
+            # 从下一个分块开始，合并到当前的目标大小；已完成的分块单独返回
+            with self.lock:
+                group = []
+                tokens = 0
+                while cursor[0] < task_total and not cursor[1]:
+                    task_idx = cursor[0]
+                    if task_idx in done_chunks:
+                        if not group:
+                            group.append(task_idx)
+                            cursor[0] += 1
+                        break
+                    if group and tokens + task_tokens[task_idx] > self.chunk_sizer.target:
+                        break
+                    group.append(task_idx)
+                    tokens += task_tokens[task_idx]
+                    cursor[0] += 1
+                return group
+
+        def regroup(group: list[int]) -> list[list[int]]:
+            # 合并的请求失败时按缩小后的目标大小重新分组，至少拆成两组
+            target = min(self.chunk_sizer.target, sum(task_tokens[task_idx] for task_idx in group) / 2)
+            groups = [[]]
+            tokens = 0
+            for task_idx in group:
+                if groups[-1] and tokens + task_tokens[task_idx] > target:
+                    groups.append([])
+                    tokens = 0
+                groups[-1].append(task_idx)
+                tokens += task_tokens[task_idx]
+            return groups
+
+        def run_group(group: list[int]):
+            results = run_tasks(group, final=len(group) == 1)
+            if results is None:
+                for sub_group in regroup(group):
+                    run_group(sub_group)
+                return
+            for task_idx, trans in zip(group, results):
+                translated_contents[task_idx] = trans
+
+        def run_adaptive():
+            while group := next_group():
+                run_group(group)
+
+        workers = max(1, self.concurrency)
+        if workers > 1 and (self.context_num > 0 or self.review_times > 0):
+            self.logger.warning("Context mode and manual review need the previous results, fall back to serial "
+                                "translation.")
+            workers = 1
+        if self.chunk_sizer is not None:
+            translated_contents: list = [None] * task_total
+            executor = ThreadPoolExecutor(max_workers=workers)
+            try:
+                for future in [executor.submit(run_adaptive) for _ in range(min(workers, task_total))]:
+                    future.result()
+            finally:
+                cursor[1] = True
+                executor.shutdown(wait=True, cancel_futures=True)
+            self.logger.info(f"Adaptive chunk size ended at {self.chunk_sizer.target:.0f} tokens.")
+        elif workers > 1 and task_total > 1:
+            self.logger.info(f"Start {min(workers, task_total)} workers for concurrent translation.")
+            # map会按提交顺序返回结果，保证restore_task拿到的顺序不变
+            executor = ThreadPoolExecutor(max_workers=min(workers, task_total))
+            try:
+                translated_contents = list(executor.map(run_split_task, range(task_total)))
+            finally:
+                # 中断时等正在进行的请求完成并记录，排队中的分块不再开始
+                executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            translated_contents = [run_split_task(task_idx) for task_idx in range(task_total)]
 
-        if self.failed > 0:
-            self.logger.warning(f"Failed tasks num: {self.failed}/{len(spilt_contents)}\n")
+        if self.failed > failed_before:
+            self.logger.warning(f"Failed tasks num: {self.failed - failed_before}/{task_total}\n")
 
-        no_cache_pgs_trans = self.restore_task(no_cache_pgs_orig, translated_contents)
+        no_cache_pgs_trans = self.restore_task(plan["no_cache_pgs_orig"], translated_contents, plan["cached_paras"])
         # 还原索引
         finished_trans = []
         finished_trans += origin_contents
-        for idx, pg in enumerate(origin_contents):
-            if idx in no_cache_pgs_idx:
-                idy = no_cache_pgs_idx.index(idx)
-                finished_trans[idx] = no_cache_pgs_trans[idy]
-            elif idx in cached_pgs_idx:
-                idy = cached_pgs_idx.index(idx)
-                finished_trans[idx] = cached_pgs_trans[idy]
-            else:
-                self.logger.error("Unknown page when apply cache")
+        for idx, trans in plan["cached_pgs"].items():
+            finished_trans[idx] = trans
+        for idy, idx in enumerate(plan["no_cache_pgs_idx"]):
+            finished_trans[idx] = no_cache_pgs_trans[idy]
+        if self.failed == failed_before:
+            self.write_job(job_manifest.finish_job, job_id)
 
         return finished_trans
 
     def estimate_consumption(self, origin_contents: list[list[str]]):
-        model_name, limit_tokens, time_out = self.judge_model(self.custom_model)
-        self.logger.info(f"Selected model: {model_name}")
-        spilt_contents = self.split_task(origin_contents, limit_tokens)
+        plan = self.plan_task(origin_contents)
         total_tokens = 0
-        for content in spilt_contents:
-            fin_glossary = self.select_glossary(self.glossary_dict, content)
+        for idx, content in enumerate(plan["spilt_contents"]):
+            if idx in plan["cached_splits"]:
+                continue
+            fin_glossary = self.gen_glossary(content)
             sys_prompt = self.gen_sys_prompt(fin_glossary)
             user_msg = self.gen_user_message(content)
-            tokens = len(self.enc.encode(sys_prompt)) + len(self.enc.encode(user_msg))
+            tokens = sum(self.token_counter.count_batch([sys_prompt, user_msg]))
             total_tokens += tokens
         self.logger.info(f"It is estimated that the prompt part needs to consume {total_tokens} tokens in total.")
+
+    def batch_id(self, origin_content: list[str]) -> str:
+        # 同一分块、目标语言和模型的custom_id不变，重复导出不会产生新的请求
+        return "ont-" + cache_base.content_hash(json.dumps([self.target_lang, self.custom_model, origin_content],
+                                                           ensure_ascii=False))
+
+    def export_batch(self, origin_contents: list[list[str]], batch_path: str, append: bool = False) -> int:
+        # 把需要请求的分块写成批处理接口的JSONL，每行是一个完整的请求
+        plan = self.plan_task(origin_contents)
+        if self.context_num > 0:
+            self.logger.warning("Batch requests are independent, the context will not be added to the prompts.")
+        exported = set()
+        with open(batch_path, 'a' if append else 'w', encoding='utf-8') as f:
+            for idx, content in enumerate(plan["spilt_contents"]):
+                custom_id = self.batch_id(content)
+                if idx in plan["cached_splits"] or custom_id in exported:
+                    continue
+                payload = self.gen_payload(content, plan["model"])
+                payload["stream"] = False
+                payload.pop("stream_options", None)
+                request = {"custom_id": custom_id, "method": "POST", "url": self.api_path, "body": payload}
+                f.write(json.dumps(request, ensure_ascii=False) + "\n")
+                self.write_job(job_manifest.save_batch_request, custom_id, content)
+                exported.add(custom_id)
+        self.flush_cache()
+        self.logger.info(f"Exported {len(exported)} batch requests to {batch_path}.")
+        return len(exported)
+
+    def ingest_batch(self, batch_path: str) -> tuple[int, int]:
+        # 读取批处理接口的结果文件，检查通过的译文写入缓存，返回 (成功数, 失败数)
+        self.flush_cache()
+        succeeded = 0
+        failed = 0
+        with open(batch_path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    result = json.loads(line)
+                    custom_id = result["custom_id"]
+                except (ValueError, TypeError, KeyError) as e:
+                    # 损坏的行找不到对应的分块，跳过它继续读取后面的结果
+                    self.logger.error(f"Can not parse the batch result line: {e!r}")
+                    failed += 1
+                    continue
+                with self.cache_lock:
+                    origin_content = job_manifest.load_batch_request(self.conn, custom_id)
+                if origin_content is None:
+                    self.logger.warning(f"Batch request {custom_id} is unknown or already ingested, skip it.")
+                    continue
+                response = result.get("response") or {}
+                body = response.get("body") or {}
+                choices = body.get("choices") or []
+                if result.get("error") or response.get("status_code") != 200 or not choices:
+                    reason = json.dumps(result.get("error") or body.get("error") or response.get("status_code"),
+                                        ensure_ascii=False)
+                    self.logger.error(f"Batch request {custom_id} failed: {reason}")
+                    self.write_failed_cache(origin_content, {}, f"Batch error: {reason}")
+                    failed += 1
+                    continue
+                usage = body.get("usage") or {}
+                prompt_num = usage.get("prompt_tokens", 0)
+                completion_num = usage.get("completion_tokens", 0)
+                with self.lock:
+                    self.prompt_token_cost += prompt_num
+                    self.completion_token_cost += completion_num
+                    self.usage_records.append({"endpoint": "batch", "url": self.api_path, "paras": len(origin_content),
+                                               "prompt": prompt_num, "completion": completion_num,
+                                               "source": "batch"})
+                if choices[0].get("finish_reason") == "length":
+                    self.logger.error(f"Batch request {custom_id} reached the max_tokens limit.")
+                    self.write_failed_cache(origin_content, {}, "Batch error: length")
+                    failed += 1
+                    continue
+                parsed_content = {}
+                try:
+                    parsed_content = self.parse_result_msg(choices[0]["message"].get("content") or '')
+                    translated = list(self.check_translation(origin_content, dict(parsed_content)).values())
+                except (ValueError, TypeError, KeyError) as e:
+                    # 无法解析或检查失败时保留可信的段落，其余段落下次导出时重新请求
+                    salvaged = self.salvage_translation(origin_content, parsed_content)
+                    if salvaged:
+                        self.write_para_cache([origin_content[idx] for idx in salvaged], list(salvaged.values()))
+                    self.write_failed_cache(origin_content, parsed_content, str(e) or type(e).__name__)
+                    self.logger.warning(f"Batch request {custom_id} failed the check, keep {len(salvaged)}/"
+                                        f"{len(origin_content)} paragraphs.")
+                    failed += 1
+                    continue
+                self.write_split_cache(origin_content, translated)
+                self.write_para_cache(origin_content, translated)
+                self.write_job(job_manifest.delete_batch_request, custom_id)
+                succeeded += 1
+        self.flush_cache()
+        self.logger.info(f"Ingested {succeeded} batch results, {failed} failed.")
+        return succeeded, failed
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import argparse
 import os
-import shutil
+import signal
+import sys
 import time
 
 from tools.boo_loader import *
@@ -22,6 +23,17 @@ if __name__ == '__main__':
     parser.add_argument('-e', '--estimate', type=bool, default=False,
                         help="If True, estimate how many tokens will be consumed in the prompt part without really "
                              "translating.")
+    parser.add_argument('--maintain-cache', action='store_true',
+                        help="Report cache statistics, evict least recently used rows down to cache_max_mb and "
+                             "vacuum the cache file, then exit.")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the interrupted translation task of this book from where it stopped.")
+    parser.add_argument('--export-batch', type=str, default=None, metavar='PATH',
+                        help="Write the requests of all uncached split tasks to a JSONL file for the batch API, "
+                             "then exit.")
+    parser.add_argument('--ingest-batch', type=str, default=None, metavar='PATH',
+                        help="Read the results JSONL of the batch API into the cache, then generate the book from "
+                             "the cache without requesting the API.")
     args = parser.parse_args()
 
     # 解析命令行参数
@@ -31,6 +43,35 @@ if __name__ == '__main__':
         logger.error("config file does not exist")
         raise FileNotFoundError
 
+    if args.maintain_cache:
+        from tools import cache_base
+
+        if 'cache_file' in config.keys() and config['cache_file'].endswith('.db'):
+            cache_file = config['cache_file']
+        elif args.book and os.path.exists(args.book):
+            cache_file = f"cache/{extra.get_file_md5(args.book)}.db"
+        else:
+            logger.error("You must set cache_file in the config file or specify a book to locate the cache file.")
+            raise ValueError
+        if not os.path.exists(cache_file):
+            logger.error(f"Cache file {cache_file} does not exist.")
+            raise FileNotFoundError
+        conn = cache_base.connect(cache_file)
+        for table_name, stats in cache_base.cache_report(conn).items():
+            if table_name == "file_bytes":
+                logger.info(f"Cache file size: {stats} bytes")
+            else:
+                logger.info(f"{table_name}: {stats['rows']} rows, {stats['bytes']} bytes, "
+                            f"hit rate {stats['hit_rate']:.2%} ({stats['hits']}/{stats['lookups']})")
+        max_mb = config.get('cache_max_mb', 0)
+        if max_mb > 0:
+            deleted = cache_base.evict_cache(conn, int(max_mb * 1024 * 1024))
+            logger.info(f"Evicted {deleted} least recently used rows.")
+        cache_base.vacuum_cache(conn)
+        logger.info(f"Cache file size after vacuum: {cache_base.cache_report(conn)['file_bytes']} bytes")
+        conn.close()
+        exit()
+
     output_dir = "."
     cache_method = 'split'
     pre_translate_title = False
@@ -57,11 +98,16 @@ if __name__ == '__main__':
 
     # 解析配置文件
     from engine.openai import OpenAITrans
+    from tools.rate_limiter import RateLimiter
 
     oat = OpenAITrans(target_lang)
 
+    # 多端点时每个端点有自己的key，顶层的api_key可以不填
+    oat.endpoints = config['openai'].get('endpoints', [])
     if 'api_key' in config['openai'].keys() and config['openai']['api_key']:
         oat.api_key = config['openai']['api_key']
+    elif oat.endpoints and all(endpoint.get('api_key') for endpoint in oat.endpoints):
+        pass
     else:
         logger.error("You must fill in a valid API key in the configuration file.")
         raise UnboundLocalError
@@ -74,14 +120,28 @@ if __name__ == '__main__':
     else:
         logger.error("Invalid API URL, please check the API base and API path values.")
         raise ValueError
+    for endpoint in oat.endpoints:
+        if not extra.is_valid_url(endpoint.get('api_base', oat.api_base) + endpoint.get('api_path', oat.api_path)):
+            logger.error(f"Invalid API URL in endpoint {endpoint.get('name', '')}, please check the endpoints.")
+            raise ValueError
 
     oat.use_unofficial_model = config['openai'].get('use_unofficial_model', False)
     oat.custom_model = config['openai'].get('model', oat.default_model)
     oat.enable_stream = config['openai'].get('enable_stream', True)
+    oat.stream_usage = config['openai'].get('stream_usage', True)
     oat.enable_dict_fmt = config['openai'].get('enable_dict_fmt', True)
     oat.custom_sys_prompt = config['openai'].get('custom_prompt', '')
     oat.context_num = config['openai'].get('context_num', 0)
     oat.review_times = config['openai'].get('review_times', oat.context_num)
+    oat.concurrency = config['openai'].get('concurrency',
+                                           sum(endpoint.get('concurrency', 1) for endpoint in oat.endpoints) or 1)
+    oat.rate_limiter = RateLimiter(config['openai'].get('rpm', 0), config['openai'].get('tpm', 0))
+    oat.connect_timeout = config['openai'].get('connect_timeout', oat.connect_timeout)
+    oat.stream_stall_timeout = config['openai'].get('stream_timeout', oat.stream_stall_timeout)
+    oat.token_counter.model_encodings.update(config['openai'].get('model_encodings', {}))
+    oat.adaptive_chunk = config['openai'].get('adaptive_chunk', False)
+    oat.chunk_min_tokens = config['openai'].get('chunk_min_tokens', 0)
+    oat.chunk_max_tokens = config['openai'].get('chunk_max_tokens', 0)
 
     oat.custom_limit_tokens = config['openai'].get('token_limit', 0)
     if oat.use_unofficial_model is True and not oat.custom_limit_tokens:
@@ -91,6 +151,7 @@ if __name__ == '__main__':
         logger.info(f"The token limit has been set to a custom value: {oat.custom_limit_tokens}.\n")
 
     oat.max_err = config.get('max_err', 3)
+    oat.bisect_failures = config.get('bisect_failures', True)
     cache_method = config.get('cache_method', 'None')
     oat.use_page_cache = cache_method == 'page'
     oat.use_split_cache = cache_method == 'split'
@@ -104,24 +165,78 @@ if __name__ == '__main__':
         cache_file = config['cache_file']
     else:
         cache_file = f"cache/{md5}.db"
+    oat.cache_compress = config.get('cache_compress', False)
+    oat.fuzzy_threshold = config.get('fuzzy_threshold', 0)
     oat.reconnect_conn(cache_file)
+    oat.resume = args.resume
+    if args.ingest_batch:
+        if not oat.use_split_cache:
+            logger.error("Batch mode needs cache_method to be split.")
+            raise ValueError
+        if not os.path.exists(args.ingest_batch):
+            logger.error(f"Batch result file {args.ingest_batch} does not exist.")
+            raise FileNotFoundError
+        oat.ingest_batch(args.ingest_batch)
+        oat.offline = True
+    # 收到终止信号时正常退出，让缓存写入线程把队列里的内容落盘
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
 
     pre_translate_title = config.get('pre_trans', False)
 
-    tmp_path = f".{md5}.tmp"
-    if os.path.exists(tmp_path) and os.path.isfile(tmp_path):
-        os.remove(tmp_path)
-    shutil.copy2(book_path, tmp_path)
-
     if book_type == "epub":
-        book = EpubBoo(tmp_path)
+        book = EpubBoo(book_path, config.get('epub_parser', 'bs4'), config.get('parse_workers', 0))
     elif book_type == "txt":
-        book = TxtBoo(tmp_path)
+        book = TxtBoo(book_path)
     else:
         raise TypeError("Undefined book type")
 
+    if book_type == "txt":
+        window_size = config.get('txt_window_pages', 0)
+    else:
+        window_size = config.get('epub_window_pages', 0)
+    if window_size > 0 and not args.estimate and not args.export_batch:
+        # 按窗口流式翻译，每译完一个窗口就写出并释放，内存占用与书的大小无关
+        saved_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        target_path = f"{output_dir}/[{saved_time}]{orig_name}"
+        part_path = target_path + ".part"
+        partial_path = f"{output_dir}/[partial]{orig_name}"
+        writer = book.open_writer(part_path)
+        try:
+            for page_keys, window_pages in book.iter_windows(window_size):
+                window_pages = book.parse_pages(window_pages)
+                window_texts = book.extract_text_from_pages(window_pages)
+                window_titles = book.extract_titles_from_pages(window_pages)
+                if pre_translate_title and window_titles:
+                    trans_titles = oat.start_task(window_titles)
+                    raw_glossary = book.add_title_glossary(window_titles, trans_titles, raw_glossary)
+                    oat.glossary_dict = oat.formatting_glossary(raw_glossary)
+                window_trans = oat.start_task(window_texts)
+                writer.write_pages(page_keys, book.apply_trans_to_pages(window_pages, window_texts, window_trans))
+                # 上下文只需要保留最近的几条
+                del oat.context_all[:max(0, len(oat.context_all) - oat.context_num)]
+        except (KeyboardInterrupt, SystemExit) as e:
+            logger.warning("Translation interrupted, saving progress.")
+            oat.flush_cache()
+            # EPUB中还没翻译的页面保持原文
+            writer.close()
+            os.replace(part_path, partial_path)
+            logger.warning(f"Finished windows were saved to {partial_path}, run again with --resume to continue.")
+            sys.exit(e.code if isinstance(e, SystemExit) else 130)
+        writer.close()
+        oat.flush_cache()
+        os.replace(part_path, target_path)
+        # 续传完成后，上次中断留下的部分译本已经过时
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        oat.log_usage()
+        logger.info("Completed Saving\n")
+        logger.info(f"Total running time: {float(time.time() - start_time)}")
+        exit()
+
     # 读取epub文件
     page_hrefs, all_pages_data = book.read_book()
+    # 每个页面只解析一次，提取和回写共用同一棵解析树
+    all_pages_data = book.parse_pages(all_pages_data)
     orig_titles = book.extract_titles_from_pages(all_pages_data)
     orig_pgs_texts = book.extract_text_from_pages(all_pages_data)
 
@@ -133,29 +248,57 @@ if __name__ == '__main__':
     if args.estimate:
         oat.estimate_consumption(orig_pgs_texts)
         exit()
+    if args.export_batch:
+        if not oat.use_split_cache:
+            logger.error("Batch mode needs cache_method to be split.")
+            raise ValueError
+        # 标题和正文的请求写进同一个文件；标题还没有译文，正文的提示词中不包含标题术语
+        exported = oat.export_batch(orig_titles, args.export_batch) if pre_translate_title and orig_titles else 0
+        exported += oat.export_batch(orig_pgs_texts, args.export_batch, append=exported > 0)
+        logger.info(f"{exported} requests were exported, run again with --ingest-batch after the batch finished.")
+        exit()
     # 准备翻译任务
 
-    if pre_translate_title and orig_titles:
-        logger.info("Translate titles before starting to translate content.\n")
-        trans_titles = oat.start_task(orig_titles)
-        raw_glossary = book.add_title_glossary(orig_titles, trans_titles, raw_glossary)
-        oat.glossary_dict = oat.formatting_glossary(raw_glossary)
-    logger.info("Begin translation of the main text.\n")
-    trans_contents = oat.start_task(orig_pgs_texts)
+    # 正文页面译完即回写，定期把已完成的页面写成部分译本，进程被强制结束时也有可用的输出
+    partial_path = f"{output_dir}/[partial]{orig_name}"
+    checkpoint = CheckpointWriter(book, partial_path, page_hrefs, all_pages_data, orig_pgs_texts,
+                                  config.get('checkpoint_interval', 30), oat.flush_cache)
+    try:
+        if pre_translate_title and orig_titles:
+            logger.info("Translate titles before starting to translate content.\n")
+            trans_titles = oat.start_task(orig_titles)
+            raw_glossary = book.add_title_glossary(orig_titles, trans_titles, raw_glossary)
+            oat.glossary_dict = oat.formatting_glossary(raw_glossary)
+        logger.info("Begin translation of the main text.\n")
+        oat.on_pages_finished = checkpoint.add_pages
+        trans_contents = oat.start_task(orig_pgs_texts)
+        oat.on_pages_finished = None
+    except (KeyboardInterrupt, SystemExit) as e:
+        # 中断时保存进度，已完成的页面写入部分译本，之后用 --resume 继续
+        logger.warning("Translation interrupted, saving progress.")
+        oat.on_pages_finished = None
+        oat.flush_cache()
+        if checkpoint.finished:
+            checkpoint.save()
+            logger.warning(f"{len(checkpoint.finished)}/{len(orig_pgs_texts)} finished pages were saved to "
+                           f"{partial_path}")
+        logger.warning("Run again with --resume to continue the task.")
+        sys.exit(e.code if isinstance(e, SystemExit) else 130)
     logger.info("Completed translation of the main text.\n")
-    logger.info(f"Total prompt tokens cost in task: {oat.prompt_token_cost}")
-    logger.info(f"Total completion tokens cost in task: {oat.completion_token_cost}")
+    oat.flush_cache()
+    oat.log_usage()
 
-    # 还原排版
+    # 还原排版，已经回写过的页面不再重复处理
     logger.info("Start saving\n")
 
-    trans_pg_data = book.apply_trans_to_pages(all_pages_data, orig_pgs_texts, trans_contents)
-    book.write_pages(tmp_path, page_hrefs, trans_pg_data)
-
+    checkpoint.apply_pages(list(enumerate(trans_contents)))
     saved_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
     target_path = f"{output_dir}/[{saved_time}]{orig_name}"
-    shutil.copy2(tmp_path, target_path)
-    os.remove(tmp_path)
+    # 直接从原书写出译本，不再复制临时文件
+    checkpoint.save(target_path)
+    # 完整译本写出后，部分译本已经过时
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
     logger.info("Completed Saving\n")
 
     end_time = time.time()
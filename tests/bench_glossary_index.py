@@ -0,0 +1,74 @@
+import os
+import random
+import string
+import tempfile
+import time
+
+from engine.openai import OpenAITrans
+
+# 20000个术语的术语表上，逐个子串查找与Aho-Corasick索引的耗时对比
+# 运行：python -m tests.bench_glossary_index
+
+TERMS = 20000
+CHUNKS = 50
+
+
+def naive_select(formatted_glossary: dict, origin_content: list[str]) -> str:
+    # 改用索引之前的实现：每个术语都在整个分块里查找一次
+    fin_glossary = ["## Glossary:"]
+    content = str(origin_content)
+    for term, term_str in formatted_glossary.items():
+        if term in content:
+            fin_glossary.append(term_str)
+    return "\n".join(fin_glossary) if len(fin_glossary) > 1 else ""
+
+
+def main():
+    rng = random.Random(1)
+    alphabet = "アイウエオカキクケコサシスセソ王国魔女騎士" + string.ascii_letters
+    raw_glossary = {}
+    while len(raw_glossary) < TERMS:
+        term = "".join(rng.choice(alphabet) for _ in range(rng.randint(2, 6)))
+        raw_glossary[term] = {"trans": term.upper(), "class": "noun"}
+    chunks = [["".join(rng.choice(alphabet + "。 ") for _ in range(200)) for _ in range(15)] for _ in range(CHUNKS)]
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.makedirs('cache')
+        try:
+            trans = OpenAITrans('English')
+            trans.logger.disabled = True
+            formatted = trans.formatting_glossary(raw_glossary)
+
+            start = time.perf_counter()
+            expected = [naive_select(formatted, chunk) for chunk in chunks]
+            naive_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            first = [trans.select_glossary(formatted, chunk) for chunk in chunks[:1]]
+            build_time = time.perf_counter() - start
+            start = time.perf_counter()
+            indexed = first + [trans.select_glossary(formatted, chunk) for chunk in chunks[1:]]
+            index_time = time.perf_counter() - start
+
+            # 新增标题术语后只插入新术语
+            raw_glossary[chunks[0][0][:5]] = {"trans": "title", "class": "title"}
+            formatted = trans.formatting_glossary(raw_glossary)
+            start = time.perf_counter()
+            updated = trans.select_glossary(formatted, chunks[0])
+            update_time = time.perf_counter() - start
+            trans.conn.close()
+        finally:
+            os.chdir(cwd)
+
+    assert indexed == expected
+    assert updated == naive_select(formatted, chunks[0])
+    print(f"{TERMS} terms, {CHUNKS} chunks of {sum(map(len, chunks[0]))} characters")
+    print(f"substring search: {naive_time / CHUNKS * 1000:.2f} ms/chunk")
+    print(f"index: build {build_time * 1000:.1f} ms, {index_time / (CHUNKS - 1) * 1000:.2f} ms/chunk, "
+          f"incremental update {update_time * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import json
+import os
+import tempfile
+import unittest
+
+from engine.openai import OpenAITrans
+from tools import job_manifest
+
+
+def result_line(custom_id: str, content: str) -> str:
+    body = {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 5}}
+    return json.dumps({"custom_id": custom_id, "response": {"status_code": 200, "body": body}, "error": None})
+
+
+class IngestBatchTest(unittest.TestCase):
+    # 导入批处理结果：检查通过的写入缓存，错位或无法解析的不写入段落缓存
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs('cache')
+        self.trans = OpenAITrans('English')
+        self.trans.logger.disabled = True
+        self.trans.custom_model = 'test'
+        self.trans.reconnect_conn('cache/test.db')
+
+    def tearDown(self):
+        self.trans.cache_writer.close()
+        self.trans.conn.close()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def ingest(self, chunks: list[list[str]], lines: list[str]) -> tuple[int, int]:
+        for chunk in chunks:
+            self.trans.write_job(job_manifest.save_batch_request, self.trans.batch_id(chunk), chunk)
+        with open('results.jsonl', 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        return self.trans.ingest_batch('results.jsonl')
+
+    def test_good_and_merged(self):
+        good = ["Good one", "Good two"]
+        merged = [f"P{idx}" for idx in range(1, 7)]
+        # 第2、3段和第4、5段被合并，之后的编号整体前移
+        merged_output = json.dumps({'1': 'T1', '2': 'T2 T3', '3': 'T4 T5', '4': 'T6'})
+        result = self.ingest([good, merged], [
+            result_line(self.trans.batch_id(good), json.dumps({'1': 'GOOD ONE', '2': 'GOOD TWO'})),
+            result_line(self.trans.batch_id(merged), merged_output)])
+        self.assertEqual(result, (1, 1))
+        self.assertEqual(self.trans.lookup_split_cache(good), ['GOOD ONE', 'GOOD TWO'])
+        self.assertEqual(self.trans.lookup_para_cache(merged), {})
+        # 失败的分块保留映射，下次导出后还能导入
+        with self.trans.cache_lock:
+            self.assertEqual(job_manifest.load_batch_request(self.trans.conn, self.trans.batch_id(merged)), merged)
+            self.assertIsNone(job_manifest.load_batch_request(self.trans.conn, self.trans.batch_id(good)))
+
+    def test_corrupt_lines(self):
+        chunk = ["Only one", "Only two"]
+        result = self.ingest([chunk], ['{"custom_id": "ont-x", "respo', '[1, 2]',
+                                       result_line(self.trans.batch_id(chunk), "Sorry, I cannot do that.")])
+        self.assertEqual(result, (0, 3))
+        self.assertEqual(self.trans.lookup_para_cache(chunk), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
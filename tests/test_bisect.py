@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from engine.openai import OpenAITrans
+
+ORIGIN = [f"P{idx}" for idx in range(1, 7)]
+# 模型把第2、3段和第4、5段各合并成一段，之后的编号整体前移
+MERGED = {'1': 'T1', '2': 'T2 T3', '3': 'T4 T5', '4': 'T6'}
+
+
+class SalvageTest(unittest.TestCase):
+    # 检查失败的译文只保留能确定对应关系的段落
+    @classmethod
+    def setUpClass(cls):
+        cls.cwd = os.getcwd()
+        cls.tmp = tempfile.TemporaryDirectory()
+        os.chdir(cls.tmp.name)
+        os.makedirs('cache')
+        cls.trans = OpenAITrans('English')
+        cls.trans.logger.disabled = True
+        cls.trans.custom_model = 'test'
+        cls.trans.reconnect_conn('cache/test.db')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.trans.cache_writer.close()
+        cls.trans.conn.close()
+        os.chdir(cls.cwd)
+        cls.tmp.cleanup()
+
+    def test_merged_paragraphs(self):
+        self.assertEqual(self.trans.salvage_translation(ORIGIN, MERGED), {})
+
+    def test_extra_paragraphs(self):
+        split = {str(idx + 1): f"T{idx + 1}" for idx in range(6)}
+        split['7'] = 'T7'
+        self.assertEqual(self.trans.salvage_translation(ORIGIN, split), {})
+
+    def test_repeat(self):
+        # 编号完整时只去掉重复的译文
+        repeated = {str(idx + 1): f"T{idx + 1}" for idx in range(6)}
+        repeated['4'] = 'T1'
+        self.assertEqual(self.trans.salvage_translation(ORIGIN, repeated),
+                         {1: 'T2', 2: 'T3', 4: 'T5', 5: 'T6'})
+
+    def test_bisect_merged_response(self):
+        # 错位的译文不能进入结果和段落缓存，所有段落都要拆分重试
+        requested = []
+
+        def request_translation(content, *args, **kwargs):
+            requested.extend(content)
+            return [para.replace('P', 'T') for para in content], True
+
+        with mock.patch.object(self.trans, 'request_translation', side_effect=request_translation):
+            translated, finished = self.trans.bisect_translate(ORIGIN, MERGED, 'test', 60, 1, 0)
+        self.trans.flush_cache()
+        self.assertTrue(finished)
+        self.assertEqual(translated, [f"T{idx}" for idx in range(1, 7)])
+        self.assertEqual(sorted(requested), ORIGIN)
+        self.assertEqual(self.trans.lookup_para_cache(ORIGIN), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
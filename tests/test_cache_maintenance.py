@@ -0,0 +1,60 @@
+import os
+import random
+import string
+import tempfile
+import unittest
+
+from tools import cache_base
+
+
+class CacheMaintenanceTest(unittest.TestCase):
+    # 淘汰后实际占用要低于上限，VACUUM后WAL要截断
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test.db')
+        self.conn = cache_base.connect(self.path)
+        rng = random.Random(1)
+        for table_name in ('split_cache', 'page_cache'):
+            cache_base.create_cache_table(self.conn, table_name)
+        for idx in range(2000):
+            # 索引和页内碎片让内容字节数明显小于文件占用，只按估算删除会删不够
+            table_name = 'split_cache' if idx % 2 else 'page_cache'
+            paras = ["".join(rng.choice(string.ascii_letters) for _ in range(rng.randint(20, 400)))]
+            cache_base.write_cache(self.conn, 'English', 'openai', 'test', paras, paras, table_name, commit=False)
+            self.conn.execute(f'''UPDATE {table_name} SET last_used=? WHERE id=last_insert_rowid()''', (idx,))
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        self.tmp.cleanup()
+
+    def last_used(self) -> list[int]:
+        return sorted(row[0] for row in self.conn.execute('''SELECT last_used FROM split_cache UNION ALL
+                                                             SELECT last_used FROM page_cache'''))
+
+    def test_evict_under_limit(self):
+        before = cache_base.used_bytes(self.conn)
+        self.assertEqual(cache_base.evict_cache(self.conn, before), 0)
+        for max_bytes in (before * 3 // 4, before // 3):
+            with self.subTest(max_bytes=max_bytes):
+                deleted = cache_base.evict_cache(self.conn, max_bytes)
+                self.assertGreater(deleted, 0)
+                self.assertLessEqual(cache_base.used_bytes(self.conn), max_bytes)
+                # 留下的是最近使用的行
+                remaining = self.last_used()
+                self.assertEqual(remaining, list(range(2000 - len(remaining), 2000)))
+
+    def test_evict_everything(self):
+        # 上限小于空表本身的大小时删除所有行后停止
+        cache_base.evict_cache(self.conn, 0)
+        self.assertEqual(self.last_used(), [])
+
+    def test_vacuum_truncates_wal(self):
+        cache_base.evict_cache(self.conn, cache_base.used_bytes(self.conn) // 3)
+        cache_base.vacuum_cache(self.conn)
+        self.assertEqual(os.path.getsize(self.path + '-wal'), 0)
+        self.assertLessEqual(os.path.getsize(self.path), cache_base.used_bytes(self.conn))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import regex
+
+from engine.openai import OpenAITrans
+from tests.test_split_pages import make_encoding
+from tools.boo_loader import CheckpointWriter, TxtBoo
+
+PAGES = [[f"the king said {page} here {line}" for line in range(6)] for page in range(5)]
+
+
+def fake_translation(content, *args, **kwargs):
+    return [para.upper() for para in content], True
+
+
+class CheckpointTest(unittest.TestCase):
+    # 中断后留下的部分译本要包含所有已完成的页面，续传时由已完成分块凑齐的页面也要回写
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.makedirs('cache')
+        self.trans = self.new_trans()
+
+    def tearDown(self):
+        self.trans.cache_writer.close()
+        self.trans.conn.close()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    @staticmethod
+    def new_trans() -> OpenAITrans:
+        enc = make_encoding()
+        trans = OpenAITrans('English')
+        trans.logger.disabled = True
+        trans.token_counter.encoder = enc
+        trans.token_counter.pattern = regex.compile(enc._pat_str)
+        trans.custom_model = 'test'
+        trans.use_unofficial_model = True
+        trans.custom_limit_tokens = 60
+        trans.enable_dict_fmt = False
+        trans.resume = True
+        trans.reconnect_conn('cache/test.db')
+        return trans
+
+    def test_partial_txt(self):
+        with open('book.txt', 'w') as f:
+            f.write("==== one\nfirst line\n==== two\nsecond line\n")
+        book = TxtBoo('book.txt')
+        page_hrefs, pages = book.read_book()
+        texts = book.extract_text_from_pages(pages)
+        checkpoint = CheckpointWriter(book, '[partial]book.txt', page_hrefs, pages, texts, 0)
+        checkpoint.add_pages([(2, ['==== TWO', 'SECOND LINE'])])
+        with open('[partial]book.txt') as f:
+            self.assertEqual(f.read(), "\n==== one\nfirst line\n==== TWO\nSECOND LINE\n")
+        # 没有新完成的页面时不重写，最终译本写到另一个文件
+        os.remove('[partial]book.txt')
+        checkpoint.save()
+        self.assertFalse(os.path.exists('[partial]book.txt'))
+        checkpoint.apply_pages(list(enumerate(book.extract_text_from_pages(pages))))
+        checkpoint.save('book_trans.txt')
+        with open('book_trans.txt') as f:
+            self.assertEqual(f.read(), "\n==== one\nfirst line\n==== TWO\nSECOND LINE\n")
+
+    def test_resume_reports_restored_pages(self):
+        calls = []
+
+        def interrupted(content, *args, **kwargs):
+            calls.append(content)
+            if len(calls) > 3:
+                raise KeyboardInterrupt
+            return fake_translation(content)
+
+        with mock.patch.object(self.trans, 'request_translation', side_effect=interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                self.trans.start_task(PAGES)
+        self.trans.flush_cache()
+        interrupted_pages = set(self.trans.job_pages)
+        self.assertTrue(interrupted_pages)
+        self.trans.cache_writer.close()
+        self.trans.conn.close()
+
+        self.trans = self.new_trans()
+        reported = []
+        self.trans.on_pages_finished = reported.extend
+        with mock.patch.object(self.trans, 'request_translation', side_effect=fake_translation):
+            result = self.trans.start_task(PAGES)
+        self.assertEqual(result, [[para.upper() for para in page] for page in PAGES])
+        self.assertEqual(sorted(idx for idx, page_trans in reported), list(range(len(PAGES))))
+        self.assertEqual(dict(reported), dict(enumerate(result)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import random
+import unittest
+import warnings
+
+from lxml import etree
+
+from tools.boo_loader import EpubBoo
+
+PROLOG = ('<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+          '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">')
+
+
+def make_page(rng: random.Random, num: int, broken: bool = False) -> bytes:
+    body = []
+    for i in range(num):
+        r = rng.random()
+        if r < 0.1:
+            body.append(f'<h2 epub:type="title">Chapter {i} title</h2>')
+        elif r < 0.2:
+            body.append(f'<p>line a {i}<br/>line b {i}</p>')
+        elif r < 0.25:
+            body.append('<p>   </p>')
+        elif r < 0.3:
+            body.append(f'<p>  indented {i} <span>inner</span> tail</p>')
+        elif r < 0.33:
+            body.append('<p><img src="x.png" alt=""/></p>')
+        elif r < 0.36:
+            body.append('<div><p>nested <b>bold</b><!-- c --> &amp; &#160;ent</p></div>')
+        elif r < 0.4:
+            body.append(f'<p class="a"><span>one {i}</span><span>two {i}</span></p>')
+        else:
+            body.append(f'<p>Paragraph {i} <ruby>漢<rt>かん</rt></ruby> text.</p>')
+    if broken:
+        # 没有DTD的实体会让页面不是合法XML，lxml后端改用HTML解析
+        body.append(f'<p>Broken&nbsp;entity {num}</p>')
+    return (PROLOG + f'<head><title>Page title {num}</title>'
+                     '<link href="s.css" rel="stylesheet" type="text/css"/></head>\n<body>\n' +
+            '\n'.join(body) + '\n</body></html>').encode()
+
+
+def translate(texts: list[list[str]]) -> list[list[str]]:
+    # 每三页留一页不翻译；多行译文覆盖逐行回写的分支
+    return [[] if idx % 3 == 0 else [para + '\nSECOND' if 'line a' in para or 'one' in para else para.upper()
+                                     for para in page]
+            for idx, page in enumerate(texts)]
+
+
+class EpubParityTest(unittest.TestCase):
+    # lxml后端的提取和回写结果要与BeautifulSoup后端一致
+    def setUp(self):
+        warnings.filterwarnings('ignore')
+        rng = random.Random(2)
+        self.pages = [make_page(rng, rng.randint(0, 40), broken=idx % 5 == 4) for idx in range(60)]
+        self.pages.append(b'<html><body><p>bare &nbsp; html<br></p></body></html>')
+        self.bs4 = EpubBoo('book.epub', 'bs4', 1)
+        self.lxml = EpubBoo('book.epub', 'lxml', 1)
+
+    def test_extraction(self):
+        bs4_pages = self.bs4.parse_pages(self.pages)
+        lxml_pages = self.lxml.parse_pages(self.pages)
+        self.assertEqual(self.bs4.extract_text_from_pages(bs4_pages), self.lxml.extract_text_from_pages(lxml_pages))
+        self.assertEqual(self.bs4.extract_titles_from_pages(bs4_pages),
+                         self.lxml.extract_titles_from_pages(lxml_pages))
+
+    def test_apply_trans(self):
+        bs4_pages = self.bs4.parse_pages(self.pages)
+        lxml_pages = self.lxml.parse_pages(self.pages)
+        texts = self.bs4.extract_text_from_pages(bs4_pages)
+        trans = translate(texts)
+        bs4_out = self.bs4.apply_trans_to_pages(bs4_pages, texts, trans)
+        lxml_out = self.lxml.apply_trans_to_pages(lxml_pages, texts, trans)
+        # 回写后重新提取的文本一致
+        check = EpubBoo('book.epub', 'bs4', 1)
+        self.assertEqual(check.extract_text_from_pages(bs4_out), check.extract_text_from_pages(lxml_out))
+        for idx, (page, out) in enumerate(zip(self.pages, lxml_out)):
+            if not trans[idx]:
+                # 没有改动的页面原样输出
+                self.assertEqual(out, page)
+            elif page.startswith(b'<?xml'):
+                # 改动过的页面仍是合法的XHTML，保留原有的XML声明和DOCTYPE
+                self.assertTrue(out.startswith(b'<?xml'), out[:120])
+                self.assertEqual(out.count(b'<?xml'), 1)
+                self.assertIn(b'<!DOCTYPE html>', out)
+                self.assertNotIn(b'HTML 4.0', out)
+                etree.fromstring(out)
+
+    def test_parallel_workers(self):
+        # 子进程中解析和回写的结果与串行一致
+        parallel = EpubBoo('book.epub', 'lxml', 2)
+        parallel.parallel_min_pages = 1
+        texts = self.lxml.extract_text_from_pages(self.pages)
+        self.assertEqual(parallel.extract_text_from_pages(self.pages), texts)
+        trans = translate(texts)
+        self.assertEqual(parallel.apply_trans_to_pages(self.pages, texts, trans),
+                         self.lxml.apply_trans_to_pages(self.pages, texts, trans))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import random
+import tempfile
+import unittest
+
+import regex
+import tiktoken
+
+from engine.openai import OpenAITrans
+
+# cl100k_base的预分词规则；词表用一个离线构造的小BPE，拼接处的token数变化与真实编码器同样依赖预分词
+CL100K_PATTERN = (r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|"""
+                  r"""\s*[\r\n]+|\s+(?!\S)|\s+""")
+WORDS = ['the', 'and', 'page', 'para', 'text', 'here', 'said', 'Alice', 'queen', 'king', '魔女', '王国', '騎士',
+         'です', 'した']
+
+
+def make_encoding() -> tiktoken.Encoding:
+    ranks = {bytes([i]): i for i in range(256)}
+    # 常见词及其前缀、空白和标点组合都作为合并后的token
+    pieces = [' ' + word for word in WORDS] + WORDS + ['\n\n', '  ', '   ', "', '", '", "', '."', '."\n', '。\n',
+                                                      ' "', "'s", '...', '!\n', '\n ']
+    for piece in pieces:
+        data = piece.encode('utf-8')
+        for end in range(2, len(data) + 1):
+            ranks.setdefault(data[:end], len(ranks))
+    return tiktoken.Encoding("test_bpe", pat_str=CL100K_PATTERN, mergeable_ranks=ranks,
+                             special_tokens={"<|endoftext|>": len(ranks)})
+
+
+def old_split_pages(enc: tiktoken.Encoding, original_pages: list[list[str]], limit_token: float,
+                    context_num: int) -> list[list[str]]:
+    # 改为增量计数之前的分块算法，每加入一段都重新编码整个分块
+    result = []
+    tmp_lst = []
+    for page in original_pages:
+        for para in page:
+            para_token = len(enc.encode(para))
+            if para_token > limit_token:
+                raise ValueError
+            if len(enc.encode("\n".join(tmp_lst + [para]))) <= limit_token:
+                tmp_lst.append(para)
+            else:
+                result.append(tmp_lst)
+                tmp_lst = [para]
+        if context_num == 0 and len(enc.encode(str(tmp_lst))) > limit_token / 3:
+            result.append(tmp_lst)
+            tmp_lst = []
+    if len(tmp_lst) > 0:
+        result.append(tmp_lst)
+    return result
+
+
+def make_book(rng: random.Random) -> list[list[str]]:
+    fillers = WORDS + ['I', "don't", '"Yes,"', "it's", '—', '、', '。', '!', '?', '42', '1999', '\t', "'quoted'",
+                       '"double"', 'x\\y', '…']
+    pages = []
+    for _ in range(rng.randint(1, 12)):
+        page = []
+        for _ in range(rng.randint(0, 25)):
+            para = ' '.join(rng.choice(fillers) for _ in range(rng.randint(1, 30)))
+            # 首尾空白和段内换行会改变拼接处的预分词
+            if rng.random() < 0.2:
+                para = ' ' * rng.randint(1, 3) + para
+            if rng.random() < 0.2:
+                para += ' ' * rng.randint(1, 3)
+            if rng.random() < 0.1:
+                para = para.replace(' ', '\n', 1)
+            page.append(para)
+        pages.append(page)
+    return pages
+
+
+class SplitPagesTest(unittest.TestCase):
+    # 增量计数的分块边界要与逐次重新编码的旧算法完全一致
+    @classmethod
+    def setUpClass(cls):
+        cls.cwd = os.getcwd()
+        cls.tmp = tempfile.TemporaryDirectory()
+        os.chdir(cls.tmp.name)
+        os.makedirs('cache')
+        cls.enc = make_encoding()
+        cls.trans = OpenAITrans('English')
+        cls.trans.token_counter.encoder = cls.enc
+        cls.trans.token_counter.pattern = regex.compile(cls.enc._pat_str)
+        cls.trans.logger.disabled = True
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.trans.conn.close()
+        os.chdir(cls.cwd)
+        cls.tmp.cleanup()
+
+    def test_same_boundaries(self):
+        rng = random.Random(4)
+        for case in range(500):
+            pages = make_book(rng)
+            context_num = rng.choice([0, 0, 1])
+            longest = max((len(self.enc.encode(para)) for page in pages for para in page), default=1)
+            limit = rng.uniform(longest, longest * 6)
+            self.trans.context_num = context_num
+            with self.subTest(case=case, limit=limit, context_num=context_num):
+                self.assertEqual(self.trans.split_pages(pages, limit),
+                                 old_split_pages(self.enc, pages, limit, context_num))
+
+    def test_paragraph_too_long(self):
+        self.trans.context_num = 0
+        with self.assertRaises(ValueError):
+            self.trans.split_pages([['the king said here and there']], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,79 +1,127 @@
 import logging
+import os
+import posixpath
 import re
+import struct
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote
+
 import ruamel.std.zipfile as zipfile
 from bs4 import BeautifulSoup
-from ruamel.std.zipfile import delete_from_zip_file
+from lxml import etree
 
 from tools import load_config, extra
 
 
 class EpubBoo:
 
-    def __init__(self, book_p):
+    def __init__(self, book_p, parser='bs4', workers=1):
         self.book_path = book_p
+        # bs4: BeautifulSoup解析；lxml: 直接用lxml解析和序列化，速度更快
+        self.parser = parser
+        # 解析和回写页面的进程数，0表示使用全部CPU
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
         load_config.configure_logging()
         self.logger = logging.getLogger(__name__)
 
     target_tags = ['p', 'h1', 'h2', 'h3', 'h4', 'h5']
     noise_tags = []
+    # 页面数少于该值时串行处理，省去启动进程池的开销
+    parallel_min_pages = 100
 
     def read_book(self):
         # 打开epub文件
         pages = []
+        items_hrefs = []
+        for href, page_data in self.iter_pages():
+            items_hrefs.append(href)
+            pages.append(page_data)
+        return items_hrefs, pages
+
+    @staticmethod
+    def spine_hrefs(epub_file: zipfile.ZipFile) -> list[str]:
+        # 按spine的阅读顺序列出页面，不在spine中的页面排在最后
+        file_names = set(epub_file.namelist())
+        # 读取epub文件中的container.xml文件
+        if 'META-INF/container.xml' not in file_names:
+            print("No 'META-INF/container.xml' file, invalid epub file.")
+            return []
+        with epub_file.open('META-INF/container.xml', 'r') as container_file:
+            soup = BeautifulSoup(container_file.read(), 'lxml-xml')
+            content_opf_path = \
+                soup.rootfiles.find('rootfile', attrs={'media-type': "application/oebps-package+xml"})['full-path']
+        with epub_file.open(content_opf_path, 'r') as content_opf:
+            soup = BeautifulSoup(content_opf.read(), 'lxml-xml')
+        opf_dir = posixpath.dirname(content_opf_path)
+        items = {}
+        for item in soup.manifest.find_all('item', attrs={'media-type': "application/xhtml+xml"}):
+            # href相对于opf文件所在目录，并且可能经过URL编码
+            items[item.get('id')] = posixpath.normpath(posixpath.join(opf_dir, unquote(item['href'].split('#')[0])))
+        ordered = []
+        if soup.spine is not None:
+            for itemref in soup.spine.find_all('itemref'):
+                href = items.get(itemref.get('idref'))
+                if href and href not in ordered:
+                    ordered.append(href)
+        ordered += [href for href in items.values() if href not in ordered]
+        return [href for href in ordered if href in file_names]
+
+    def iter_pages(self):
+        # 需要时才读取页面内容
         with zipfile.ZipFile(self.book_path, 'r') as epub_file:
-            file_names = epub_file.namelist()
-            # 读取epub文件中的container.xml文件
-            if 'META-INF/container.xml' not in file_names:
-                print("No 'META-INF/container.xml' file, invalid epub file.")
-                return [], []
-
-            with epub_file.open('META-INF/container.xml', 'r') as container_file:
-                soup = BeautifulSoup(container_file.read(), 'lxml-xml')
-                content_opf_path = \
-                    soup.rootfiles.find('rootfile', attrs={'media-type': "application/oebps-package+xml"})['full-path']
-            with epub_file.open(content_opf_path, 'r') as content_opf:
-                soup = BeautifulSoup(content_opf.read(), 'lxml-xml')
-                items = soup.manifest.find_all('item', attrs={'media-type': "application/xhtml+xml"})
-                items_hrefs = [content_opf_path.replace('content.opf', item['href']) for item in items]
-            for href in items_hrefs:
+            for href in self.spine_hrefs(epub_file):
                 with epub_file.open(href, 'r') as page_file:
-                    pages.append(page_file.read())
-        return items_hrefs, pages
+                    yield href, page_file.read()
+
+    def iter_windows(self, window_size: int):
+        hrefs, window = [], []
+        for href, page_data in self.iter_pages():
+            hrefs.append(href)
+            window.append(page_data)
+            if len(window) >= window_size:
+                yield hrefs, window
+                hrefs, window = [], []
+        if window:
+            yield hrefs, window
+
+    def open_writer(self, tg_path: str) -> 'EpubWriter':
+        return EpubWriter(self.book_path, tg_path)
+
+    def map_pages(self, func, tasks: list) -> list:
+        # 页面较多时在进程池中处理，结果按页面顺序返回
+        if self.workers > 1 and len(tasks) >= self.parallel_min_pages:
+            workers = min(self.workers, len(tasks))
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(func, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+        return [func(task) for task in tasks]
+
+    def parse_pages(self, pages_data: list) -> list['EpubPage']:
+        raw_idx = [idx for idx, page in enumerate(pages_data) if not isinstance(page, EpubPage)]
+        if not raw_idx:
+            return list(pages_data)
+        pages = list(pages_data)
+        if self.workers > 1 and len(raw_idx) >= self.parallel_min_pages:
+            # 子进程只返回提取结果，回写时再在子进程里重新解析
+            results = self.map_pages(extract_page, [(pages_data[idx], self.target_tags, self.parser)
+                                                    for idx in raw_idx])
+            for idx, (texts, titles) in zip(raw_idx, results):
+                pages[idx] = ExtractedPage(pages_data[idx], texts, titles)
+        else:
+            for idx in raw_idx:
+                pages[idx] = page_class(self.parser)(pages_data[idx], self.target_tags)
+        return pages
 
     # 提取需要翻译的文本
 
     def extract_text_from_pages(self, pages_data: list) -> list[list[str]]:
-        BeautifulSoup(features='lxml')
-        all_pages_text = []
-        for page_data in pages_data:
-            soup = BeautifulSoup(page_data, features='lxml')
-            texts: list[str] = [tag.get_text() for tag in soup.find_all(self.target_tags) if tag.get_text().strip()]
-            all_pages_text.append(texts)
-
-        return all_pages_text
+        return [list(page.texts) for page in self.parse_pages(pages_data)]
 
-    @staticmethod
-    def extract_titles_from_pages(pages_data: list) -> list[list[str]]:
-        BeautifulSoup(features='lxml')
+    def extract_titles_from_pages(self, pages_data: list) -> list[list[str]]:
         all_titles = []
-        for page_data in pages_data:
-            soup = BeautifulSoup(page_data, features='lxml')
-            titles = []
-            try:
-                t1 = soup.title.get_text()
-                if len(t1.strip()) > 2:
-                    titles.append(t1)
-            except AttributeError:
-                pass
-            for s in soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5']):
-                t = s.get_text()
-                if len(t.strip()) > 2 and t not in titles:
-                    titles.append(t)
-            for s in soup.find_all(attrs={"epub:type": "title"}):
-                t = s.get_text()
-                if len(t.strip()) > 2 and t not in titles:
-                    titles.append(t)
-            filter_titles = [title for title in titles if extra.is_text(title)]
+        for page in self.parse_pages(pages_data):
+            filter_titles = [title for title in page.titles if extra.is_text(title)]
             if filter_titles:
                 all_titles.append(filter_titles)
 
@@ -91,37 +139,21 @@ class EpubBoo:
             return a
 
     # 用译文替换原文，并保留排版
-    def apply_trans_to_pages(self, pages_data: list[bytes], original_contents: list[list[str]],
+    def apply_trans_to_pages(self, pages_data: list, original_contents: list[list[str]],
                              trans_cts: list[list[str]]) -> list[bytes]:
-        translated_pages = []
-        BeautifulSoup(features='lxml')
-        for idx, page in enumerate(pages_data):
-            soup = BeautifulSoup(page, features='lxml')
-            para_count = 0
-            for node in soup.find_all(self.target_tags):
-                para = node.text
-                if para and para == original_contents[idx][para_count]:
-                    para_trans = trans_cts[idx][para_count]
-                    trans_split = para_trans.splitlines()
-                    trans_split = [sub for sub in trans_split if sub]
-                    # 处理一个标签里有多行内容的问题😅
-                    if len(trans_split) > 1 and len(trans_split) == len(
-                            [sub.get_text().strip() for sub in node.contents if sub.get_text().strip()]):
-                        trans_gen = (sub for sub in trans_split)
-                        for sub in node.contents:
-                            if sub.get_text().strip():
-                                try:
-                                    sub_trans = next(trans_gen)
-                                    sub.string = sub_trans
-                                except StopIteration:
-                                    self.logger.error("Error while applying translation to a tag with multiple lines.")
-                                    break
-                    else:
-                        para_trans = self.fix_indent(para_trans, para)
-                        node.string = para_trans
-                    para_count += 1
-            # logger.debug(f"页面{idx}共有{para_count}段被成功还原.")
-            translated_pages.append(str(soup).encode('utf-8'))
+        pages = self.parse_pages(pages_data)
+        translated_pages = [b''] * len(pages)
+        extracted_idx = []
+        for idx, page in enumerate(pages):
+            if isinstance(page, ExtractedPage):
+                extracted_idx.append(idx)
+            else:
+                page.apply_trans(original_contents[idx], trans_cts[idx])
+                translated_pages[idx] = page.serialize()
+        results = self.map_pages(apply_page, [(pages[idx].page_data, self.target_tags, self.parser,
+                                               original_contents[idx], trans_cts[idx]) for idx in extracted_idx])
+        for idx, page_data in zip(extracted_idx, results):
+            translated_pages[idx] = page_data
         return translated_pages
 
     def add_title_glossary(self, orig: list[list[str]], trans: list[list[str]], old_glossary: dict) -> dict:
@@ -137,12 +169,281 @@ class EpubBoo:
                     }
         return old_glossary
 
+    def write_pages(self, tg_path: str, pg_hrefs: list[str], translated_pages_data: list):
+        # 从原书一次性写出新文件：译文页面替换原页面，其余条目不解压直接复制
+        translated = dict(zip(pg_hrefs, translated_pages_data))
+        part_path = tg_path + '.part'
+        with zipfile.ZipFile(self.book_path, 'r') as src, zipfile.ZipFile(part_path, 'w') as dst:
+            self.write_mimetype(src, dst)
+            for info in src.infolist():
+                if info.filename == 'mimetype':
+                    continue
+                if info.filename in translated:
+                    dst.writestr(zipfile.ZipInfo(info.filename, info.date_time), translated[info.filename],
+                                 zipfile.ZIP_DEFLATED)
+                else:
+                    self.copy_zip_entry(src, dst, info)
+        os.replace(part_path, tg_path)
+
+    def write_partial(self, tg_path: str, pg_hrefs: list[str], pages_data: list, finished: dict[int, bytes]):
+        # 只写入已完成的页面，其余页面从原书复制
+        page_idxs = sorted(finished)
+        self.write_pages(tg_path, [pg_hrefs[idx] for idx in page_idxs], [finished[idx] for idx in page_idxs])
+
     @staticmethod
-    def write_pages(tg_path: str, pg_hrefs: list[str], translated_pages_data: list):
-        delete_from_zip_file(tg_path, file_names=pg_hrefs)
-        with zipfile.ZipFile(tg_path, 'a') as epub_file:
-            for idx, href in enumerate(pg_hrefs):
-                epub_file.writestr(href, translated_pages_data[idx])
+    def write_mimetype(src: zipfile.ZipFile, dst: zipfile.ZipFile):
+        # mimetype必须是第一个条目且不压缩
+        mimetype = next((info for info in src.infolist() if info.filename == 'mimetype'), None)
+        dst.writestr(zipfile.ZipInfo('mimetype', mimetype.date_time if mimetype else (1980, 1, 1, 0, 0, 0)),
+                     src.read(mimetype) if mimetype else b'application/epub+zip', zipfile.ZIP_STORED)
+
+    @staticmethod
+    def copy_zip_entry(src: zipfile.ZipFile, dst: zipfile.ZipFile, info: zipfile.ZipInfo):
+        # 按原始压缩数据复制条目，省去解压和重新压缩
+        if info.flag_bits & 0x01:
+            dst.writestr(info, src.read(info))
+            return
+        # 本地文件头固定30字节，之后是文件名和扩展字段，再之后才是压缩数据
+        src.fp.seek(info.header_offset)
+        header = src.fp.read(30)
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        src.fp.seek(info.header_offset + 30 + name_len + extra_len)
+        new_info = zipfile.ZipInfo(info.filename, info.date_time)
+        new_info.compress_type = info.compress_type
+        new_info.comment = info.comment
+        new_info.create_system = info.create_system
+        new_info.create_version = info.create_version
+        new_info.extract_version = info.extract_version
+        new_info.internal_attr = info.internal_attr
+        new_info.external_attr = info.external_attr
+        # 大小和CRC都已知，写在本地文件头里，不再需要数据描述符
+        new_info.flag_bits = info.flag_bits & ~0x08
+        new_info.CRC = info.CRC
+        new_info.compress_size = info.compress_size
+        new_info.file_size = info.file_size
+        new_info.header_offset = dst.fp.tell()
+        dst.fp.write(new_info.FileHeader())
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = src.fp.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Truncated entry {info.filename}")
+            dst.fp.write(chunk)
+            remaining -= len(chunk)
+        dst.filelist.append(new_info)
+        dst.NameToInfo[new_info.filename] = new_info
+        dst.start_dir = dst.fp.tell()
+        dst._didModify = True
+
+
+class EpubWriter:
+    # 边翻译边写出：译完的页面随时写入，关闭时原样复制其余条目
+    def __init__(self, book_path: str, tg_path: str):
+        self.src = zipfile.ZipFile(book_path, 'r')
+        self.dst = zipfile.ZipFile(tg_path, 'w')
+        self.written = {'mimetype'}
+        EpubBoo.write_mimetype(self.src, self.dst)
+
+    def write_pages(self, pg_hrefs: list[str], translated_pages_data: list):
+        for href, page_data in zip(pg_hrefs, translated_pages_data):
+            info = self.src.getinfo(href)
+            self.dst.writestr(zipfile.ZipInfo(href, info.date_time), page_data, zipfile.ZIP_DEFLATED)
+            self.written.add(href)
+
+    def close(self):
+        for info in self.src.infolist():
+            if info.filename not in self.written:
+                EpubBoo.copy_zip_entry(self.src, self.dst, info)
+        self.dst.close()
+        self.src.close()
+
+
+class EpubPage:
+    # 每个页面只解析一次，保存解析树、需要翻译的节点和提取出的文本、标题
+    def __init__(self, page_data: bytes, target_tags: list[str]):
+        self.soup = BeautifulSoup(page_data, features='lxml')
+        self.nodes = []
+        self.texts: list[str] = []
+        for tag in self.soup.find_all(target_tags):
+            text = tag.get_text()
+            if text.strip():
+                self.nodes.append(tag)
+                self.texts.append(text)
+        self.titles = self.find_titles()
+
+    def find_titles(self) -> list[str]:
+        titles = []
+        try:
+            t1 = self.soup.title.get_text()
+            if len(t1.strip()) > 2:
+                titles.append(t1)
+        except AttributeError:
+            pass
+        for s in self.soup.find_all(['h1', 'h2', 'h3', 'h4', 'h5']):
+            t = s.get_text()
+            if len(t.strip()) > 2 and t not in titles:
+                titles.append(t)
+        for s in self.soup.find_all(attrs={"epub:type": "title"}):
+            t = s.get_text()
+            if len(t.strip()) > 2 and t not in titles:
+                titles.append(t)
+        return titles
+
+    def apply_trans(self, original_content: list[str], trans_content: list[str]):
+        # 直接写回解析时记录的节点，不再重新查找匹配
+        for node, para, orig, para_trans in zip(self.nodes, self.texts, original_content, trans_content):
+            if para != orig:
+                continue
+            trans_split = para_trans.splitlines()
+            trans_split = [sub for sub in trans_split if sub]
+            # 处理一个标签里有多行内容的问题😅
+            subs = self.text_children(node)
+            if len(trans_split) > 1 and len(trans_split) == len(subs):
+                for sub, sub_trans in zip(subs, trans_split):
+                    self.set_text(sub, sub_trans)
+            else:
+                para_trans = EpubBoo.fix_indent(para_trans, para)
+                self.set_text(node, para_trans)
+
+    @staticmethod
+    def text_children(node) -> list:
+        return [sub for sub in node.contents if sub.get_text().strip()]
+
+    @staticmethod
+    def set_text(node, text: str):
+        node.string = text
+
+    def serialize(self) -> bytes:
+        return str(self.soup).encode('utf-8')
+
+
+class LxmlEpubPage(EpubPage):
+    # 与EpubPage提取结果一致的lxml实现，没有改动的页面原样输出
+    xhtml_ns = 'http://www.w3.org/1999/xhtml'
+    epub_type = '{http://www.idpf.org/2007/ops}type'
+
+    def __init__(self, page_data: bytes, target_tags: list[str]):
+        self.page_data = page_data
+        self.changed = False
+        try:
+            self.root = etree.fromstring(page_data, etree.XMLParser(resolve_entities=False, huge_tree=True))
+            self.method = 'xml'
+        except etree.XMLSyntaxError:
+            # 不是合法XML时按HTML解析，与BeautifulSoup的lxml解析器一致
+            self.root = etree.fromstring(page_data, etree.HTMLParser())
+            self.method = 'html'
+        self.nodes = []
+        self.texts: list[str] = []
+        if self.root is not None:
+            for tag in self.root.iter(*self.qualified(target_tags)):
+                text = self.get_text(tag)
+                if text.strip():
+                    self.nodes.append(tag)
+                    self.texts.append(text)
+        self.titles = self.find_titles()
+
+    def qualified(self, tags: list[str]) -> list[str]:
+        return tags + [f'{{{self.xhtml_ns}}}{tag}' for tag in tags]
+
+    # BeautifulSoup的get_text不包含注音、脚本、样式和模板里的文本
+    skip_tags = {'rt', 'rp', 'script', 'style', 'template', '{http://www.w3.org/1999/xhtml}rt',
+                 '{http://www.w3.org/1999/xhtml}rp', '{http://www.w3.org/1999/xhtml}script',
+                 '{http://www.w3.org/1999/xhtml}style', '{http://www.w3.org/1999/xhtml}template'}
+
+    def get_text(self, node) -> str:
+        if next(node.iter(*self.skip_tags), None) is None:
+            return ''.join(node.itertext())
+        parts = []
+        self.collect_text(node, parts)
+        return ''.join(parts)
+
+    def collect_text(self, node, parts: list[str]):
+        if node.text:
+            parts.append(node.text)
+        for child in node:
+            # 注释和处理指令的tag不是字符串，只保留它们后面的文本
+            if isinstance(child.tag, str) and child.tag not in self.skip_tags:
+                self.collect_text(child, parts)
+            if child.tail:
+                parts.append(child.tail)
+
+    def find_titles(self) -> list[str]:
+        titles = []
+        if self.root is None:
+            return titles
+        title = next(self.root.iter(*self.qualified(['title'])), None)
+        if title is not None:
+            t1 = self.get_text(title)
+            if len(t1.strip()) > 2:
+                titles.append(t1)
+        for s in self.root.iter(*self.qualified(['h1', 'h2', 'h3', 'h4', 'h5'])):
+            t = self.get_text(s)
+            if len(t.strip()) > 2 and t not in titles:
+                titles.append(t)
+        for s in self.root.iter(etree.Element):
+            if s.get(self.epub_type, s.get('epub:type')) == "title":
+                t = self.get_text(s)
+                if len(t.strip()) > 2 and t not in titles:
+                    titles.append(t)
+        return titles
+
+    def text_children(self, node) -> list:
+        # 对应BeautifulSoup的node.contents：文本片段用字符串表示，子元素用元素本身表示
+        subs = []
+        if node.text and node.text.strip():
+            subs.append(node.text)
+        for child in node:
+            if isinstance(child.tag, str) and self.get_text(child).strip():
+                subs.append(child)
+            if child.tail and child.tail.strip():
+                subs.append(child.tail)
+        return subs
+
+    def set_text(self, node, text: str):
+        # 与BeautifulSoup一致，文本片段不能单独赋值
+        if isinstance(node, str):
+            return
+        for child in list(node):
+            node.remove(child)
+        node.text = text
+        self.changed = True
+
+    def serialize(self) -> bytes:
+        if not self.changed:
+            return self.page_data
+        if self.method == 'xml':
+            return etree.tostring(self.root.getroottree(), encoding='utf-8',
+                                  xml_declaration=self.page_data.lstrip().startswith(b'<?xml'))
+        # 按HTML解析的页面仍然输出XHTML：保留原文中根元素之前的XML声明和DOCTYPE，空元素自闭合
+        start = re.search(rb'<html[\s>]', self.page_data, re.IGNORECASE)
+        prolog = self.page_data[:start.start()] if start else b''
+        return prolog + etree.tostring(self.root, method='xml', encoding='utf-8', with_tail=False)
+
+
+class ExtractedPage(EpubPage):
+    # 在子进程中解析过的页面，只保留原始内容和提取结果
+    def __init__(self, page_data: bytes, texts: list[str], titles: list[str]):
+        self.page_data = page_data
+        self.nodes = []
+        self.texts = texts
+        self.titles = titles
+
+
+def page_class(parser: str):
+    return LxmlEpubPage if parser == 'lxml' else EpubPage
+
+
+def extract_page(task: tuple) -> tuple[list[str], list[str]]:
+    page_data, target_tags, parser = task
+    page = page_class(parser)(page_data, target_tags)
+    return page.texts, page.titles
+
+
+def apply_page(task: tuple) -> bytes:
+    page_data, target_tags, parser, original_content, trans_content = task
+    page = page_class(parser)(page_data, target_tags)
+    page.apply_trans(original_content, trans_content)
+    return page.serialize()
 
 
 class TxtBoo(EpubBoo):
@@ -154,6 +455,10 @@ class TxtBoo(EpubBoo):
             r"Ch\. \d+: (.+)",
             r"Section \d+\.\d+: (.+)"
         ]
+        self.title_regexes = [re.compile(pattern) for pattern in self.title_patterns]
+
+    # 流式读取时单页的最大行数，没有分页标记的书也不会整本读入内存
+    max_page_lines = 5000
 
     def read_book(self):
         with open(self.book_path, "r") as boo:
@@ -172,16 +477,49 @@ class TxtBoo(EpubBoo):
         pgs.append(lines[pg_mk_line_nums[-1]:])
         return pg_mk_line_nums, pgs
 
+    def parse_pages(self, pgs: list[list[str]]) -> list[list[str]]:
+        return pgs
+
+    def iter_pages(self):
+        # 逐行读取，遇到分页标记时产出一页
+        page = []
+        with open(self.book_path, "r") as boo:
+            for line in boo:
+                line = line.rstrip()
+                if page and (any(mark in line for mark in self.page_marks) or len(page) >= self.max_page_lines):
+                    yield page
+                    page = []
+                page.append(line)
+        if page:
+            yield page
+
+    def iter_windows(self, window_size: int):
+        # 与EpubBoo一致，产出 (页面编号, 页面)
+        page_nums, window = [], []
+        for page_num, page in enumerate(self.iter_pages()):
+            page_nums.append(page_num)
+            window.append(page)
+            if len(window) >= window_size:
+                yield page_nums, window
+                page_nums, window = [], []
+        if window:
+            yield page_nums, window
+
+    @staticmethod
+    def open_writer(tg_path: str) -> 'TxtWriter':
+        return TxtWriter(tg_path)
+
     def extract_text_from_pages(self, pgs: list[list[str]]) -> list[list[str]]:
-        return [list(filter(lambda x: x.strip(), sublist)) for sublist in pgs if any(x.strip() for x in sublist)]
+        # 空白页面保留为空列表，与pgs的索引一一对应
+        return [list(filter(lambda x: x.strip(), sublist)) for sublist in pgs]
 
     def extract_titles_from_pages(self, pgs: list) -> list[list[str]]:
         all_title_lines = []
         for pg in pgs:
             pg_title_lines = []
             for line in pg:
-                for pattern in self.title_patterns:
-                    match = re.match(pattern, line)
+                for regex in self.title_regexes:
+                    match = regex.match(line)
                     if match:
                         pg_title_lines.append(line)
                         break
@@ -195,10 +533,10 @@ class TxtBoo(EpubBoo):
         for pg_idx, page in enumerate(pages_data):
             orig_content = original_contents[pg_idx]
             orig_generator = (line for line in orig_content)
-            one_orig_line = next(orig_generator)
+            one_orig_line = next(orig_generator, "")
             trans_content = trans_cts[pg_idx]
             trans_generator = (line for line in trans_content)
-            one_trans_line = next(trans_generator)
+            one_trans_line = next(trans_generator, "")
             trans_page = []
             for line in page:
                 if line != one_orig_line or one_orig_line == "":
@@ -219,7 +557,82 @@ class TxtBoo(EpubBoo):
 
     @staticmethod
     def write_pages(tg_path: str, pg_hrefs: list[str], translated_pages_data: list[list[str]]):
-        with open(tg_path, "w") as boo:
-            for pg in translated_pages_data:
-                boo.write("\n".join(pg))
-                boo.write("\n")
+        part_path = tg_path + '.part'
+        with open(part_path, "w") as boo:
+            TxtBoo.append_pages(boo, translated_pages_data)
+        os.replace(part_path, tg_path)
+
+    def write_partial(self, tg_path: str, pg_hrefs: list[str], pages_data: list[list[str]],
+                      finished: dict[int, list[str]]):
+        # 未完成的页面保留原文
+        self.write_pages(tg_path, pg_hrefs, [finished.get(idx, page) for idx, page in enumerate(pages_data)])
+
+    @staticmethod
+    def append_pages(boo, translated_pages_data: list[list[str]]):
+        for pg in translated_pages_data:
+            boo.write("\n".join(pg))
+            boo.write("\n")
+
+
+class TxtWriter:
+    def __init__(self, tg_path: str):
+        self.boo = open(tg_path, "w")
+
+    def write_pages(self, pg_nums: list[int], translated_pages_data: list[list[str]]):
+        TxtBoo.append_pages(self.boo, translated_pages_data)
+        self.boo.flush()
+
+    def close(self):
+        self.boo.close()
+
+
+class CheckpointWriter:
+    # 译完的页面随时回写，每隔interval秒把已完成的页面连同其余原文写成一本完整的书；
+    # 先写临时文件再替换，进程被强制结束时留下的也是上一次写出的完整译本
+    def __init__(self, book: EpubBoo, tg_path: str, pg_hrefs: list, pages_data: list,
+                 original_contents: list[list[str]], interval: float = 30, before_save=None):
+        self.book = book
+        self.tg_path = tg_path
+        self.pg_hrefs = pg_hrefs
+        self.pages_data = pages_data
+        self.original_contents = original_contents
+        self.interval = interval
+        # 写出前先让任务清单落盘，部分译本中的页面不会多于续传时能恢复的页面
+        self.before_save = before_save
+        self.finished: dict = {}
+        self.saved_num = 0
+        self.last_save = time.time()
+        # add_pages持有锁时会调用save
+        self.lock = threading.RLock()
+
+    def apply_pages(self, finished_pages: list[tuple[int, list[str]]]):
+        # 每个页面只回写一次；页面较多时apply_trans_to_pages会在进程池中处理
+        with self.lock:
+            finished_pages = [(idx, page_trans) for idx, page_trans in finished_pages if idx not in self.finished]
+        if not finished_pages:
+            return
+        page_idxs = [idx for idx, page_trans in finished_pages]
+        translated = self.book.apply_trans_to_pages([self.pages_data[idx] for idx in page_idxs],
+                                                    [self.original_contents[idx] for idx in page_idxs],
+                                                    [page_trans for idx, page_trans in finished_pages])
+        with self.lock:
+            self.finished.update(zip(page_idxs, translated))
+
+    def add_pages(self, finished_pages: list[tuple[int, list[str]]]):
+        # 翻译线程中调用，距上次写出超过interval秒时更新部分译本
+        self.apply_pages(finished_pages)
+        with self.lock:
+            if time.time() - self.last_save >= self.interval:
+                if self.before_save:
+                    self.before_save()
+                self.save()
+
+    def save(self, tg_path: str = ''):
+        # 没有新完成的页面时不重写checkpoint
+        with self.lock:
+            if not tg_path and len(self.finished) == self.saved_num:
+                return
+            self.book.write_partial(tg_path or self.tg_path, self.pg_hrefs, self.pages_data, self.finished)
+            if not tg_path:
+                self.saved_num = len(self.finished)
+                self.last_save = time.time()
@@ -1,49 +1,242 @@
+import atexit
+import hashlib
 import json
+import logging
+import queue
 import sqlite3
+import threading
 import time
+import zlib
 from sqlite3 import Connection
 
+logger = logging.getLogger(__name__)
+
+CACHE_TABLES = ['split_cache', 'page_cache', 'para_cache']
+
+
+def connect(cache_path: str, check_same_thread=True) -> Connection:
+    conn = sqlite3.connect(cache_path, check_same_thread=check_same_thread)
+    # WAL模式下后台写入不会阻塞查询
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-16000')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
 
 def reconnect_conn(conn: Connection, cache_path: str):
     conn.close()
-    conn = sqlite3.connect(cache_path)
+    conn = connect(cache_path, check_same_thread=False)
     return conn
 
 
+def content_hash(original: str) -> str:
+    return hashlib.blake2b(original.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def encode_payload(text: str, compress=False) -> str | bytes:
+    # 压缩后的内容以BLOB保存，未压缩的仍是TEXT，读取时按类型区分
+    if compress:
+        return zlib.compress(text.encode('utf-8'), 6)
+    return text
+
+
+def decode_payload(value: str | bytes | None) -> str | None:
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+
+def add_column(conn: Connection, table_name: str, column: str, column_type: str) -> bool:
+    c = conn.cursor()
+    columns = [row[1] for row in c.execute(f'''PRAGMA table_info({table_name})''')]
+    if column in columns:
+        return False
+    c.execute(f'''ALTER TABLE {table_name} ADD COLUMN {column} {column_type}''')
+    return True
+
+
+def create_cache_table(conn: Connection, table_name: str):
+    c = conn.cursor()
+    c.execute(f'''CREATE TABLE IF NOT EXISTS {table_name}
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                target TEXT,
+                engine TEXT,
+                model TEXT,
+                original TEXT,
+                trans TEXT,
+                hash TEXT,
+                last_used INTEGER DEFAULT 0)''')
+    columns = [row[1] for row in c.execute(f'''PRAGMA table_info({table_name})''')]
+    if 'hash' not in columns:
+        migrate_cache_table(conn, table_name)
+    add_column(conn, table_name, 'last_used', 'INTEGER DEFAULT 0')
+    c.execute(f'''CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_key
+                ON {table_name} (target, engine, model, hash)''')
+    conn.commit()
+
+
+def create_stats_table(conn: Connection):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_stats
+                (table_name TEXT PRIMARY KEY,
+                lookups INTEGER DEFAULT 0,
+                hits INTEGER DEFAULT 0)''')
+    conn.commit()
+
+
+def migrate_cache_table(conn: Connection, table_name: str):
+    # 旧版缓存表没有hash列，原地补齐hash并去掉重复行（保留最早写入的一行，与旧版查询结果一致）
+    c = conn.cursor()
+    c.execute(f'''ALTER TABLE {table_name} ADD COLUMN hash TEXT''')
+    rows = c.execute(f'''SELECT id, original FROM {table_name}''').fetchall()
+    c.executemany(f'''UPDATE {table_name} SET hash=? WHERE id=?''',
+                  [(content_hash(decode_payload(original) or ''), row_id) for row_id, original in rows])
+    c.execute(f'''DELETE FROM {table_name} WHERE id NOT IN
+                (SELECT MIN(id) FROM {table_name} GROUP BY target, engine, model, hash)''')
+    conn.commit()
+
+
 def lookup_cache(conn: Connection, target_lang: str, engine: str, model: str, original_content: list[str],
-                 table_name: str):
+                 table_name: str, hit_ids: list | None = None):
+    original = json.dumps(original_content, ensure_ascii=False)
     c = conn.cursor()
-    c.execute(f'''SELECT trans FROM {table_name} WHERE target=? AND engine=? AND model=? AND original=?''',
-              (target_lang, engine, model, json.dumps(original_content, ensure_ascii=False)))
+    c.execute(f'''SELECT original, trans, id FROM {table_name} WHERE target=? AND engine=? AND model=? AND hash=?''',
+              (target_lang, engine, model, content_hash(original)))
     result = c.fetchone()
-    if result:
-        return json.loads(result[0])
+    # hash命中后仍需核对原文
+    if result and decode_payload(result[0]) == original:
+        if hit_ids is not None:
+            hit_ids.append(result[2])
+        return json.loads(decode_payload(result[1]))
     else:
-        return result
+        return None
+
+
+def lookup_cache_bulk(conn: Connection, target_lang: str, engine: str, model: str, contents: list[list[str]],
+                      table_name: str, hit_ids: list | None = None) -> dict[int, list[str]]:
+    # 一次查询多条缓存，返回 {contents中的索引: 译文}
+    originals = {}
+    for idx, content in enumerate(contents):
+        original = json.dumps(content, ensure_ascii=False)
+        originals.setdefault(content_hash(original), (original, []))[1].append(idx)
+    hash_lst = list(originals.keys())
+    found = {}
+    c = conn.cursor()
+    for i in range(0, len(hash_lst), 500):
+        part = hash_lst[i:i + 500]
+        c.execute(f'''SELECT original, trans, hash, id FROM {table_name} WHERE target=? AND engine=? AND model=?
+                        AND hash IN ({", ".join("?" * len(part))})''', (target_lang, engine, model, *part))
+        for original, trans, content_key, row_id in c.fetchall():
+            expected, idxs = originals[content_key]
+            if decode_payload(original) == expected:
+                if hit_ids is not None:
+                    hit_ids.append(row_id)
+                trans_content = json.loads(decode_payload(trans))
+                for idx in idxs:
+                    found[idx] = trans_content
+    return found
 
 
 def write_cache(conn: Connection, target_lang: str, engine: str, model: str, original_content: list[str],
-                trans_content: list[str], table_name: str, allow_overwrite=False):
+                trans_content: list[str], table_name: str, allow_overwrite=False, commit=True, compress=False):
     if not original_content:
         return
+    original = json.dumps(original_content, ensure_ascii=False)
+    trans = json.dumps(trans_content, ensure_ascii=False)
+    row = (target_lang, engine, model, encode_payload(original, compress), encode_payload(trans, compress),
+           content_hash(original), int(time.time()))
     c = conn.cursor()
-    result = lookup_cache(conn, target_lang, engine, model, original_content, table_name)
-    if result is not None and not allow_overwrite:
-        return
-    elif result is not None and allow_overwrite:
-        c.execute('''UPDATE ? SET trans=? WHERE target=? AND engine=? AND model=? AND original=?''',
-                  (table_name, json.dumps(trans_content, ensure_ascii=False), target_lang, engine, model,
-                   json.dumps(original_content, ensure_ascii=False)))
+    if allow_overwrite:
+        c.execute(f'''INSERT INTO {table_name} (target, engine, model, original, trans, hash, last_used)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (target, engine, model, hash) DO UPDATE SET trans=excluded.trans,
+                        last_used=excluded.last_used''', row)
     else:
-        c.execute(f'''INSERT INTO {table_name} (target, engine, model, original, trans)
-                                VALUES (?, ?, ?, ?, ?)''',
-                  (target_lang, engine, model, json.dumps(original_content, ensure_ascii=False),
-                   json.dumps(trans_content, ensure_ascii=False)))
+        c.execute(f'''INSERT OR IGNORE INTO {table_name} (target, engine, model, original, trans, hash, last_used)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)''', row)
+    if commit:
+        conn.commit()
+
+
+def create_para_cache_table(conn: Connection):
+    c = conn.cursor()
+    exists = c.execute('''SELECT name FROM sqlite_master WHERE type='table' AND name='para_cache' ''').fetchone()
+    c.execute(f'''CREATE TABLE IF NOT EXISTS para_cache
+                (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                target TEXT,
+                engine TEXT,
+                model TEXT,
+                original TEXT,
+                trans TEXT,
+                hash TEXT,
+                chunk_hash TEXT,
+                last_used INTEGER DEFAULT 0)''')
+    add_column(conn, 'para_cache', 'last_used', 'INTEGER DEFAULT 0')
+    c.execute(f'''CREATE UNIQUE INDEX IF NOT EXISTS para_cache_key
+                ON para_cache (target, engine, model, hash)''')
+    if not exists:
+        backfill_para_cache(conn)
     conn.commit()
 
 
+def backfill_para_cache(conn: Connection):
+    # 把已有的分块缓存拆成段落写入段落缓存
+    read = conn.cursor()
+    read.execute('''SELECT target, engine, model, original, trans, hash FROM split_cache''')
+    while rows := read.fetchmany(1000):
+        for target_lang, engine, model, original, trans, chunk_hash in rows:
+            try:
+                original_content = json.loads(decode_payload(original))
+                trans_content = json.loads(decode_payload(trans))
+            except (TypeError, json.JSONDecodeError, zlib.error):
+                continue
+            if isinstance(original_content, list) and isinstance(trans_content, list) and \
+                    len(original_content) == len(trans_content):
+                write_para_cache(conn, target_lang, engine, model, original_content, trans_content, chunk_hash,
+                                 commit=False)
+
+
+def lookup_para_cache(conn: Connection, target_lang: str, engine: str, model: str, paras: list[str],
+                      hit_ids: list | None = None) -> dict:
+    found = {}
+    hashes = {}
+    for para in paras:
+        hashes[content_hash(para)] = para
+    hash_lst = list(hashes.keys())
+    c = conn.cursor()
+    for i in range(0, len(hash_lst), 500):
+        part = hash_lst[i:i + 500]
+        c.execute(f'''SELECT original, trans, hash, id FROM para_cache WHERE target=? AND engine=? AND model=?
+                        AND hash IN ({", ".join("?" * len(part))})''', (target_lang, engine, model, *part))
+        for original, trans, para_hash, row_id in c.fetchall():
+            original = decode_payload(original)
+            # hash命中后仍需核对原文
+            if hashes.get(para_hash) == original:
+                if hit_ids is not None:
+                    hit_ids.append(row_id)
+                found[original] = decode_payload(trans)
+    return found
+
+
+def write_para_cache(conn: Connection, target_lang: str, engine: str, model: str, original_content: list[str],
+                     trans_content: list[str], chunk_hash: str, commit=True, compress=False):
+    c = conn.cursor()
+    now = int(time.time())
+    c.executemany('''INSERT OR IGNORE INTO para_cache
+                                (target, engine, model, original, trans, hash, chunk_hash, last_used)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                  [(target_lang, engine, model, encode_payload(para, compress),
+                    encode_payload(trans_content[i], compress), content_hash(para), chunk_hash, now)
+                   for i, para in enumerate(original_content) if para.strip()])
+    if commit:
+        conn.commit()
+
+
 def write_failed_cache(conn: Connection, target_lang: str, engine: str, model: str, original_content: list[str],
-                       trans_content: list | dict):
+                       trans_content: list | dict, saved_time: str = '', reason: str = '', depth: int = 0,
+                       parent: str = '', commit=True):
+    # 每次失败的尝试记一行，depth是拆分的层数，parent是被拆分的分块的hash
     from tools.extra import list2dict
     c = conn.cursor()
     if isinstance(trans_content, list):
@@ -51,9 +244,238 @@ def write_failed_cache(conn: Connection, target_lang: str, engine: str, model: s
     else:
         trans = trans_content
     orig = list2dict(original_content)
-    saved_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    c.execute(f'''INSERT INTO failed_cache (target, engine, model, original, trans, time)
-                                VALUES (?, ?, ?, ?, ?, ?)''',
+    if not saved_time:
+        saved_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    c.execute(f'''INSERT INTO failed_cache (target, engine, model, original, trans, time, reason, depth, parent)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
               (target_lang, engine, model, json.dumps(orig, ensure_ascii=False),
-               json.dumps(trans, ensure_ascii=False), saved_time))
+               json.dumps(trans, ensure_ascii=False), saved_time, reason, depth, parent))
+    if commit:
+        conn.commit()
+
+
+def touch_cache(conn: Connection, table_name: str, row_ids: list[int], used_time: int, commit=True):
+    c = conn.cursor()
+    c.executemany(f'''UPDATE {table_name} SET last_used=? WHERE id=?''', [(used_time, row_id) for row_id in row_ids])
+    if commit:
+        conn.commit()
+
+
+def add_cache_stats(conn: Connection, table_name: str, lookups: int, hits: int, commit=True):
+    c = conn.cursor()
+    c.execute('''INSERT INTO cache_stats (table_name, lookups, hits) VALUES (?, ?, ?)
+                ON CONFLICT (table_name) DO UPDATE SET lookups=lookups+excluded.lookups, hits=hits+excluded.hits''',
+              (table_name, lookups, hits))
+    if commit:
+        conn.commit()
+
+
+def cache_report(conn: Connection) -> dict:
+    # 各缓存表的行数、累计命中率和占用字节数
+    c = conn.cursor()
+    tables = [row[0] for row in c.execute('''SELECT name FROM sqlite_master WHERE type='table' ''')
+              if row[0] in CACHE_TABLES + ['failed_cache']]
+    stats = {}
+    if c.execute('''SELECT name FROM sqlite_master WHERE type='table' AND name='cache_stats' ''').fetchone():
+        stats = {row[0]: (row[1], row[2]) for row in c.execute('''SELECT table_name, lookups, hits FROM cache_stats''')}
+    report = {}
+    for table_name in tables:
+        rows, payload_bytes = c.execute(f'''SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(original AS BLOB)) +
+                                            LENGTH(CAST(trans AS BLOB))), 0) FROM {table_name}''').fetchone()
+        lookups, hits = stats.get(table_name, (0, 0))
+        report[table_name] = {
+            "rows": rows,
+            "bytes": payload_bytes,
+            "lookups": lookups,
+            "hits": hits,
+            "hit_rate": hits / lookups if lookups else 0.0
+        }
+    page_size = c.execute('''PRAGMA page_size''').fetchone()[0]
+    page_count = c.execute('''PRAGMA page_count''').fetchone()[0]
+    report["file_bytes"] = page_size * page_count
+    return report
+
+
+def used_bytes(conn: Connection) -> int:
+    # 数据库实际占用的字节数，不含空闲页
+    c = conn.cursor()
+    page_size = c.execute('''PRAGMA page_size''').fetchone()[0]
+    page_count = c.execute('''PRAGMA page_count''').fetchone()[0]
+    freelist = c.execute('''PRAGMA freelist_count''').fetchone()[0]
+    return page_size * (page_count - freelist)
+
+
+def evict_cache(conn: Connection, max_bytes: int) -> int:
+    # 按last_used从旧到新删除缓存行，每轮删除后重新测量，直到实际占用不超过上限
+    c = conn.cursor()
+    tables = [row[0] for row in c.execute('''SELECT name FROM sqlite_master WHERE type='table' ''')
+              if row[0] in CACHE_TABLES]
+    if not tables:
+        return 0
+    union = " UNION ALL ".join(f'''SELECT '{table_name}' AS table_name, id, last_used,
+                                   LENGTH(CAST(original AS BLOB)) + LENGTH(CAST(trans AS BLOB)) AS size
+                                   FROM {table_name}''' for table_name in tables)
+    deleted = 0
+    while (file_bytes := used_bytes(conn)) > max_bytes:
+        total_bytes = c.execute(f'''SELECT COALESCE(SUM(size), 0) FROM ({union})''').fetchone()[0]
+        if not total_bytes:
+            break
+        # 用内容字节数占文件大小的比例估算需要删除多少内容；索引和页内碎片使估算偏少时，每轮至少删除5%
+        need_free = max((file_bytes - max_bytes) * total_bytes / file_bytes, total_bytes / 20)
+        victims: dict[str, list[int]] = {}
+        freed = 0
+        for table_name, row_id, last_used, size in c.execute(f'''{union} ORDER BY 3 ASC, 2 ASC''').fetchall():
+            if freed >= need_free:
+                break
+            victims.setdefault(table_name, []).append(row_id)
+            freed += size or 0
+        if not victims:
+            break
+        for table_name, row_ids in victims.items():
+            c.executemany(f'''DELETE FROM {table_name} WHERE id=?''', [(row_id,) for row_id in row_ids])
+            deleted += len(row_ids)
+        if 'para_cache' in victims:
+            from tools.translation_memory import prune_index
+            prune_index(conn, commit=False)
+        conn.commit()
+    return deleted
+
+
+def vacuum_cache(conn: Connection):
     conn.commit()
+    conn.execute('''VACUUM''')
+    # VACUUM把重建的数据库写进WAL，之后再检查点并截断，文件才会立即变小
+    conn.execute('''PRAGMA wal_checkpoint(TRUNCATE)''')
+
+
+class CacheWriter:
+    # 后台线程批量写入缓存，达到数量或时间阈值时在一个事务里提交
+    def __init__(self, cache_path: str, batch_size: int = 64, flush_interval: float = 2.0, compress=False,
+                 index_tm=False):
+        self.cache_path = cache_path
+        self.compress = compress
+        self.index_tm = index_tm
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        # 尚未落盘的写入，查询缓存时也要能读到
+        self.pending: dict[tuple, list[str] | str] = {}
+        self.pending_lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='cache-writer', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write_cache(self, target_lang: str, engine: str, model: str, original_content: list[str],
+                    trans_content: list[str], table_name: str, allow_overwrite=False):
+        if not original_content:
+            return
+        key = (table_name, target_lang, engine, model, json.dumps(original_content, ensure_ascii=False))
+        with self.pending_lock:
+            if key in self.pending and not allow_overwrite:
+                return
+            self.pending[key] = trans_content
+        self.queue.put(([(key, trans_content)], write_cache, (target_lang, engine, model, original_content,
+                                                               trans_content, table_name, allow_overwrite),
+                        {"compress": self.compress}))
+
+    def write_para_cache(self, target_lang: str, engine: str, model: str, original_content: list[str],
+                         trans_content: list[str], chunk_hash: str):
+        pending_items = []
+        with self.pending_lock:
+            for i, para in enumerate(original_content):
+                key = ('para_cache', target_lang, engine, model, para)
+                if key not in self.pending:
+                    self.pending[key] = trans_content[i]
+                    pending_items.append((key, trans_content[i]))
+        self.queue.put((pending_items, write_para_cache, (target_lang, engine, model, original_content,
+                                                          trans_content, chunk_hash), {"compress": self.compress}))
+
+    def write_failed_cache(self, target_lang: str, engine: str, model: str, original_content: list[str],
+                           trans_content: list | dict, reason: str = '', depth: int = 0, parent: str = ''):
+        saved_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        self.queue.put(([], write_failed_cache, (target_lang, engine, model, original_content, trans_content,
+                                                 saved_time, reason, depth, parent), {}))
+
+    def submit(self, func, *args):
+        # 其它需要在写入线程里执行的数据库操作，函数的第一个参数是连接
+        self.queue.put(([], func, args, {}))
+
+    def touch(self, table_name: str, row_ids: list[int]):
+        if row_ids:
+            self.queue.put(([], touch_cache, (table_name, row_ids, int(time.time())), {}))
+
+    def record_stats(self, table_name: str, lookups: int, hits: int):
+        if lookups:
+            self.queue.put(([], add_cache_stats, (table_name, lookups, hits), {}))
+
+    def lookup_pending(self, target_lang: str, engine: str, model: str, original_content: list[str],
+                       table_name: str):
+        key = (table_name, target_lang, engine, model, json.dumps(original_content, ensure_ascii=False))
+        with self.pending_lock:
+            return self.pending.get(key)
+
+    def lookup_pending_paras(self, target_lang: str, engine: str, model: str, paras: list[str]) -> dict:
+        with self.pending_lock:
+            return {para: self.pending[key] for para in paras
+                    if (key := ('para_cache', target_lang, engine, model, para)) in self.pending}
+
+    def flush(self):
+        if self.closed or not self.thread.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        atexit.unregister(self.close)
+
+    def run(self):
+        conn = connect(self.cache_path)
+        batch = []
+        batch_started = 0.0
+        running = True
+        while running:
+            waiters = []
+            timeout = max(0.0, self.flush_interval - (time.monotonic() - batch_started)) if batch else None
+            try:
+                item = self.queue.get(timeout=timeout)
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    if not batch:
+                        batch_started = time.monotonic()
+                    batch.append(item)
+            except queue.Empty:
+                pass
+            if batch and (len(batch) >= self.batch_size or waiters or not running or
+                          time.monotonic() - batch_started >= self.flush_interval):
+                self.commit_batch(conn, batch)
+                batch = []
+            for waiter in waiters:
+                waiter.set()
+        conn.close()
+
+    def commit_batch(self, conn: Connection, batch: list):
+        try:
+            with conn:
+                for pending_items, func, args, kwargs in batch:
+                    func(conn, *args, commit=False, **kwargs)
+                if self.index_tm:
+                    from tools.translation_memory import index_paras
+                    index_paras(conn, commit=False)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to write {len(batch)} cache entries: {e}")
+        with self.pending_lock:
+            for pending_items, func, args, kwargs in batch:
+                for key, value in pending_items:
+                    if self.pending.get(key) is value:
+                        del self.pending[key]
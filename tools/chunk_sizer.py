@@ -0,0 +1,55 @@
+import threading
+
+
+class ChunkSizer:
+    # 根据观察到的延迟、译文长度和失败情况调整每次请求的原文token数，目标是单位时间内成功翻译的token最多
+    def __init__(self, min_tokens: float, max_tokens: float, initial_tokens: float, step: float = 0.15,
+                 smoothing: float = 0.3):
+        self.min_tokens = max(1.0, float(min_tokens))
+        self.max_tokens = max(self.min_tokens, float(max_tokens))
+        self.step = step
+        self.smoothing = smoothing
+        # 译文与原文的token比，以及触发长度上限时的补全token数
+        self.ratio = 0.0
+        self.max_completion = 0
+        self.target = self.clamp(initial_tokens)
+        self.fail_rate = 0.0
+        # 成功请求的吞吐量（原文token/秒）和爬山方向
+        self.speed = 0.0
+        self.direction = 1
+        self.lock = threading.Lock()
+
+    def clamp(self, tokens: float) -> float:
+        tokens = min(self.max_tokens, max(self.min_tokens, tokens))
+        # 补全token数会超出上限的大小不再尝试
+        if self.max_completion and self.ratio > 0:
+            tokens = min(tokens, max(self.min_tokens, 0.8 * self.max_completion / self.ratio))
+        return tokens
+
+    def smooth(self, old: float, new: float) -> float:
+        return new if old <= 0 else old + self.smoothing * (new - old)
+
+    def observe(self, source_tokens: int, completion_tokens: int, latency: float, status: str):
+        # status: ok 成功，length 输出被截断，invalid 译文检查失败
+        with self.lock:
+            self.fail_rate += self.smoothing * ((status != 'ok') - self.fail_rate)
+            if status == 'length':
+                if completion_tokens:
+                    self.max_completion = min(self.max_completion or completion_tokens, completion_tokens)
+                # 截断说明这个大小已经放不下，直接减半
+                self.target = self.clamp(min(self.target, source_tokens) * 0.5)
+                self.direction = 1
+                self.speed = 0.0
+            elif status == 'invalid':
+                self.target = self.clamp(min(self.target, source_tokens) * (1 - self.step))
+                self.direction = -1
+            elif source_tokens > 0 and latency > 0:
+                if completion_tokens:
+                    self.ratio = self.smooth(self.ratio, completion_tokens / source_tokens)
+                # 失败重试的代价按失败率折算进吞吐量，比上次好就沿原方向继续，否则掉头
+                speed = source_tokens / latency * (1 - self.fail_rate)
+                if speed < self.speed:
+                    self.direction = -self.direction
+                self.speed = self.smooth(self.speed, speed)
+                self.target = self.clamp(self.target * (1 + self.step * self.direction))
+            return self.target
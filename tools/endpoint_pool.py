@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+
+import requests
+
+from tools.rate_limiter import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class Endpoint:
+    def __init__(self, name: str, url: str, key: str, model: str = '', weight: float = 1.0, concurrency: int = 1,
+                 rate_limiter: RateLimiter | None = None):
+        self.name = name
+        self.url = url
+        self.key = key
+        self.model = model
+        self.weight = max(weight, 0.01)
+        self.concurrency = max(1, concurrency)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.inflight = 0
+        # 熔断状态：连续失败次数、熔断到期时间、是否正在试探，认证失败的端点直接停用
+        self.failures = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.disabled = False
+
+
+class EndpointPool:
+    # 多个API端点之间按进行中的请求数/权重分配请求，连续失败的端点熔断一段时间后再试探
+    def __init__(self, endpoints: list[Endpoint], failure_threshold: int = 3, cooldown: float = 30.0):
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.cond = threading.Condition()
+
+    def usable(self, endpoint: Endpoint, now: float) -> bool:
+        if endpoint.disabled or endpoint.inflight >= endpoint.concurrency:
+            return False
+        if endpoint.failures >= self.failure_threshold:
+            # 熔断期间不用；到期后只放行一个试探请求
+            return endpoint.open_until <= now and not endpoint.probing
+        return True
+
+    def acquire(self, exclude: set[str] | None = None) -> Endpoint:
+        exclude = exclude or set()
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                alive = [endpoint for endpoint in self.endpoints if not endpoint.disabled]
+                if not alive:
+                    raise requests.exceptions.HTTPError("All API endpoints are disabled.")
+                candidates = [endpoint for endpoint in alive if self.usable(endpoint, now)]
+                # 这个分块失败过的端点尽量换掉，只剩它们时也继续用
+                preferred = [endpoint for endpoint in candidates if endpoint.name not in exclude]
+                if candidates:
+                    endpoint = min(preferred or candidates, key=lambda ep: (ep.inflight + 1) / ep.weight)
+                    endpoint.inflight += 1
+                    if endpoint.failures >= self.failure_threshold:
+                        endpoint.probing = True
+                    return endpoint
+                reopen = [endpoint.open_until - now for endpoint in alive if endpoint.open_until > now]
+                self.cond.wait(min(reopen) if reopen else None)
+
+    def release(self, endpoint: Endpoint, status: str):
+        # status: ok 正常，busy 被限流，fail 服务端或网络错误，fatal 认证失败或被禁止访问
+        with self.cond:
+            endpoint.inflight -= 1
+            endpoint.probing = False
+            if status == 'ok':
+                endpoint.failures = 0
+            elif status == 'fatal':
+                endpoint.disabled = True
+                logger.error(f"Endpoint {endpoint.name} was disabled.")
+            elif status == 'fail':
+                endpoint.failures += 1
+                if endpoint.failures >= self.failure_threshold:
+                    # 反复失败时熔断时间加倍，最多16倍
+                    delay = self.cooldown * 2 ** min(endpoint.failures - self.failure_threshold, 4)
+                    endpoint.open_until = time.monotonic() + delay
+                    logger.warning(f"Endpoint {endpoint.name} failed {endpoint.failures} times in a row, "
+                                   f"pause it for {delay:.0f}s.")
+            self.cond.notify_all()
+
+    def all_disabled(self) -> bool:
+        with self.cond:
+            return all(endpoint.disabled for endpoint in self.endpoints)
@@ -58,10 +58,11 @@ def is_text(s):
 
 
 def get_file_md5(file_path):
+    md5 = hashlib.md5()
     with open(file_path, 'rb') as f:
-        data = f.read()
-        md5_value = hashlib.md5(data).hexdigest()
-    return md5_value
+        while chunk := f.read(1024 * 1024):
+            md5.update(chunk)
+    return md5.hexdigest()
 
 
 def is_valid_url(uurl):
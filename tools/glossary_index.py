@@ -0,0 +1,92 @@
+import threading
+from collections import deque
+
+
+class GlossaryIndex:
+    # Aho-Corasick自动机，一次扫描找出文本中出现的所有术语
+    def __init__(self, terms=()):
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.output: list[list[int]] = [[]]
+        self.full_output: list[list[int]] = [[]]
+        self.terms: list[str] = []
+        self.term_ids: dict[str, int] = {}
+        self.dirty = False
+        # 并发翻译时多个线程会同时查找和补充术语，插入、重建和查找都要持有锁
+        self.lock = threading.RLock()
+        for term in terms:
+            self.add(term)
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __contains__(self, term: str):
+        return term in self.term_ids
+
+    def add(self, term: str):
+        with self.lock:
+            self.insert(term)
+
+    def insert(self, term: str):
+        if not term or term in self.term_ids:
+            return
+        term_id = len(self.terms)
+        self.terms.append(term)
+        self.term_ids[term] = term_id
+        state = 0
+        for char in term:
+            nxt = self.goto[state].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][char] = nxt
+            state = nxt
+        self.output[state].append(term_id)
+        # 新增术语只插入字典树，失败指针在下一次查找前统一重建
+        self.dirty = True
+
+    def update(self, terms):
+        with self.lock:
+            for term in terms:
+                self.insert(term)
+
+    def build(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            fail = [0] * len(self.goto)
+            # 每个状态的完整输出 = 自身输出 + 失败指针链上的输出
+            full_output = [list(out) for out in self.output]
+            queue = deque(self.goto[0].values())
+            while queue:
+                state = queue.popleft()
+                for char, nxt in self.goto[state].items():
+                    queue.append(nxt)
+                    f = fail[state]
+                    while f and char not in self.goto[f]:
+                        f = fail[f]
+                    fail[nxt] = self.goto[f].get(char, 0)
+                    full_output[nxt] += full_output[fail[nxt]]
+            self.fail = fail
+            self.full_output = full_output
+            self.dirty = False
+
+    def find(self, text: str) -> list[str]:
+        # 按术语加入的顺序返回出现过的术语
+        with self.lock:
+            if self.dirty:
+                self.build()
+            goto = self.goto
+            fail = self.fail
+            full_output = self.full_output
+            found = set()
+            state = 0
+            for char in text:
+                while state and char not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(char, 0)
+                if full_output[state]:
+                    found.update(full_output[state])
+            return [self.terms[term_id] for term_id in sorted(found)]
@@ -0,0 +1,172 @@
+import bisect
+import json
+import threading
+import time
+from sqlite3 import Connection
+
+from tools.cache_base import encode_payload, decode_payload
+
+
+def create_job_tables(conn: Connection):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                (job_id TEXT PRIMARY KEY,
+                plan BLOB,
+                status TEXT,
+                updated INTEGER)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS job_chunks
+                (job_id TEXT,
+                chunk_idx INTEGER,
+                trans TEXT,
+                PRIMARY KEY (job_id, chunk_idx))''')
+    c.execute('''CREATE TABLE IF NOT EXISTS job_pages
+                (job_id TEXT,
+                page_idx INTEGER,
+                trans TEXT,
+                PRIMARY KEY (job_id, page_idx))''')
+    # 导出到批处理文件的请求，custom_id对应的原文，导入结果时用来还原分块
+    c.execute('''CREATE TABLE IF NOT EXISTS batch_requests
+                (custom_id TEXT PRIMARY KEY,
+                original TEXT,
+                created INTEGER)''')
+    conn.commit()
+
+
+def save_job(conn: Connection, job_id: str, plan: dict, commit=True):
+    # 新建任务时清掉同一任务上次留下的进度
+    c = conn.cursor()
+    c.execute('''DELETE FROM job_chunks WHERE job_id=?''', (job_id,))
+    c.execute('''DELETE FROM job_pages WHERE job_id=?''', (job_id,))
+    c.execute('''INSERT OR REPLACE INTO jobs (job_id, plan, status, updated) VALUES (?, ?, ?, ?)''',
+              (job_id, encode_payload(json.dumps(plan, ensure_ascii=False), True), 'running', int(time.time())))
+    if commit:
+        conn.commit()
+
+
+def save_chunk(conn: Connection, job_id: str, chunk_idx: int, trans_content: list[str], commit=True):
+    c = conn.cursor()
+    c.execute('''INSERT OR REPLACE INTO job_chunks (job_id, chunk_idx, trans) VALUES (?, ?, ?)''',
+              (job_id, chunk_idx, json.dumps(trans_content, ensure_ascii=False)))
+    c.execute('''UPDATE jobs SET updated=? WHERE job_id=?''', (int(time.time()), job_id))
+    if commit:
+        conn.commit()
+
+
+def save_page(conn: Connection, job_id: str, page_idx: int, trans_content: list[str], commit=True):
+    c = conn.cursor()
+    c.execute('''INSERT OR REPLACE INTO job_pages (job_id, page_idx, trans) VALUES (?, ?, ?)''',
+              (job_id, page_idx, json.dumps(trans_content, ensure_ascii=False)))
+    if commit:
+        conn.commit()
+
+
+def finish_job(conn: Connection, job_id: str, commit=True):
+    # 任务完成后译文都在缓存和输出文件里，清单不再需要
+    c = conn.cursor()
+    c.execute('''DELETE FROM job_chunks WHERE job_id=?''', (job_id,))
+    c.execute('''DELETE FROM job_pages WHERE job_id=?''', (job_id,))
+    c.execute('''DELETE FROM jobs WHERE job_id=?''', (job_id,))
+    if commit:
+        conn.commit()
+
+
+def save_batch_request(conn: Connection, custom_id: str, original_content: list[str], commit=True):
+    c = conn.cursor()
+    c.execute('''INSERT OR REPLACE INTO batch_requests (custom_id, original, created) VALUES (?, ?, ?)''',
+              (custom_id, json.dumps(original_content, ensure_ascii=False), int(time.time())))
+    if commit:
+        conn.commit()
+
+
+def load_batch_request(conn: Connection, custom_id: str) -> list[str] | None:
+    c = conn.cursor()
+    row = c.execute('''SELECT original FROM batch_requests WHERE custom_id=?''', (custom_id,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def delete_batch_request(conn: Connection, custom_id: str, commit=True):
+    c = conn.cursor()
+    c.execute('''DELETE FROM batch_requests WHERE custom_id=?''', (custom_id,))
+    if commit:
+        conn.commit()
+
+
+def load_job(conn: Connection, job_id: str) -> tuple[dict, dict[int, list[str]]] | None:
+    c = conn.cursor()
+    row = c.execute('''SELECT plan FROM jobs WHERE job_id=? AND status='running' ''', (job_id,)).fetchone()
+    if not row:
+        return None
+    plan = json.loads(decode_payload(row[0]))
+    # JSON的键都是字符串，还原成索引
+    for key in ("cached_pgs", "cached_splits"):
+        plan[key] = {int(idx): trans for idx, trans in plan[key].items()}
+    plan["fuzzy_refs"] = {para: tuple(match) for para, match in plan.get("fuzzy_refs", {}).items()}
+    chunks = {chunk_idx: json.loads(trans) for chunk_idx, trans in
+              c.execute('''SELECT chunk_idx, trans FROM job_chunks WHERE job_id=?''', (job_id,))}
+    return plan, chunks
+
+
+class JobProgress:
+    # 根据已完成的分块判断哪些页面的译文已经齐全
+    def __init__(self, pages: list[list[str]], cached_paras: dict, chunks: list[list[str]]):
+        self.pages = pages
+        self.cached_paras = cached_paras
+        self.chunk_starts = []
+        pos = 0
+        for chunk in chunks:
+            self.chunk_starts.append(pos)
+            pos += len(chunk)
+        self.page_ranges = []
+        pos = 0
+        for page in pages:
+            need_num = len([para for para in page if para not in cached_paras])
+            self.page_ranges.append((pos, pos + need_num))
+            pos += need_num
+        self.page_starts = [start for start, end in self.page_ranges]
+        self.chunk_results: dict[int, list[str]] = {}
+        self.pending_pages = set(range(len(pages)))
+        self.lock = threading.Lock()
+
+    def chunk_of(self, pos: int) -> int:
+        return bisect.bisect_right(self.chunk_starts, pos) - 1
+
+    def add_chunk(self, chunk_idx: int, trans_content: list[str]) -> list[tuple[int, list[str]]]:
+        # 只检查与这个分块有交集的页面，返回因此完成的页面 [(页面索引, 译文)]
+        with self.lock:
+            self.chunk_results[chunk_idx] = trans_content
+            start = self.chunk_starts[chunk_idx]
+            end = start + len(trans_content)
+            page_idx = max(0, bisect.bisect_right(self.page_starts, start) - 1)
+            candidates = []
+            while page_idx < len(self.page_ranges) and self.page_ranges[page_idx][0] < end:
+                if page_idx in self.pending_pages:
+                    candidates.append(page_idx)
+                page_idx += 1
+            return self.take_finished(candidates)
+
+    def collect_finished(self) -> list[tuple[int, list[str]]]:
+        with self.lock:
+            return self.take_finished(sorted(self.pending_pages))
+
+    def take_finished(self, candidates: list[int]) -> list[tuple[int, list[str]]]:
+        finished = []
+        for page_idx in candidates:
+            page_trans = self.restore_page(page_idx)
+            if page_trans is not None:
+                finished.append((page_idx, page_trans))
+                self.pending_pages.discard(page_idx)
+        return finished
+
+    def restore_page(self, page_idx: int) -> list[str] | None:
+        start, end = self.page_ranges[page_idx]
+        flat = []
+        for pos in range(start, end):
+            chunk_idx = self.chunk_of(pos)
+            chunk = self.chunk_results.get(chunk_idx)
+            offset = pos - self.chunk_starts[chunk_idx]
+            if chunk is None or offset >= len(chunk):
+                return None
+            flat.append(chunk[offset])
+        page_trans = iter(flat)
+        return [self.cached_paras[para] if para in self.cached_paras else next(page_trans)
+                for para in self.pages[page_idx]]
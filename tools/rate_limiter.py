@@ -0,0 +1,129 @@
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+
+class RateLimiter:
+    # 令牌桶：分别按每分钟请求数(rpm)和每分钟token数(tpm)限流，值为0表示不限制
+    def __init__(self, rpm: int = 0, tpm: int = 0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_allowance = float(rpm)
+        self.token_allowance = float(tpm)
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now: float):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        if self.rpm > 0:
+            self.request_allowance = min(float(self.rpm), self.request_allowance + elapsed * self.rpm / 60.0)
+        if self.tpm > 0:
+            self.token_allowance = min(float(self.tpm), self.token_allowance + elapsed * self.tpm / 60.0)
+
+    def acquire(self, tokens: int = 0):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                # 单个请求超过整个桶时，等桶满了再放行，避免永远等待
+                need_tokens = min(tokens, self.tpm) if self.tpm > 0 else 0
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.rpm > 0 and self.request_allowance < 1:
+                        wait = (1 - self.request_allowance) * 60.0 / self.rpm
+                    elif self.tpm > 0 and self.token_allowance < need_tokens:
+                        wait = (need_tokens - self.token_allowance) * 60.0 / self.tpm
+                    else:
+                        if self.rpm > 0:
+                            self.request_allowance -= 1
+                        if self.tpm > 0:
+                            self.token_allowance -= need_tokens
+                        return tokens
+            time.sleep(wait + random.uniform(0, 0.1))
+
+    def settle(self, reserved: int, used: int):
+        # 用实际消耗修正预留的token数
+        if self.tpm <= 0:
+            return
+        with self.lock:
+            self.token_allowance = min(float(self.tpm), self.token_allowance + reserved - used)
+
+    def penalize(self, delay: float):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            self.request_allowance = min(self.request_allowance, 0.0)
+
+    def update_from_headers(self, headers):
+        limit_requests = self.parse_int(headers.get('x-ratelimit-limit-requests'))
+        limit_tokens = self.parse_int(headers.get('x-ratelimit-limit-tokens'))
+        remaining_requests = self.parse_int(headers.get('x-ratelimit-remaining-requests'))
+        remaining_tokens = self.parse_int(headers.get('x-ratelimit-remaining-tokens'))
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            # 服务器给出的额度比配置更小时，以服务器为准
+            if limit_requests and (self.rpm <= 0 or limit_requests < self.rpm):
+                self.rpm = limit_requests
+                self.request_allowance = min(self.request_allowance, float(limit_requests))
+            if limit_tokens and (self.tpm <= 0 or limit_tokens < self.tpm):
+                self.tpm = limit_tokens
+                self.token_allowance = min(self.token_allowance, float(limit_tokens))
+            if self.rpm > 0 and remaining_requests is not None:
+                self.request_allowance = min(self.request_allowance, float(remaining_requests))
+            if self.tpm > 0 and remaining_tokens is not None:
+                self.token_allowance = min(self.token_allowance, float(remaining_tokens))
+            if remaining_requests == 0:
+                reset = self.parse_duration(headers.get('x-ratelimit-reset-requests'))
+                if reset:
+                    self.blocked_until = max(self.blocked_until, now + reset)
+            if remaining_tokens == 0:
+                reset = self.parse_duration(headers.get('x-ratelimit-reset-tokens'))
+                if reset:
+                    self.blocked_until = max(self.blocked_until, now + reset)
+
+    @staticmethod
+    def parse_int(value) -> int | None:
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def parse_duration(value) -> float:
+        # 解析形如 "6m0s"、"1.5s"、"20ms" 的重置时间
+        if not value:
+            return 0.0
+        units = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+        seconds = 0.0
+        for num, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value):
+            seconds += float(num) * units[unit]
+        return seconds
+
+    @staticmethod
+    def parse_retry_after(headers) -> float:
+        value = headers.get('retry-after-ms')
+        if value:
+            try:
+                return float(value) / 1000.0
+            except ValueError:
+                pass
+        value = headers.get('retry-after')
+        if not value:
+            return 0.0
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0.0
+
+    @staticmethod
+    def backoff_time(err_count: int, base: float = 2.0, cap: float = 120.0) -> float:
+        # 指数退避加全抖动，避免并发请求同时重试
+        return random.uniform(base, min(cap, base * 2 ** (err_count + 1)))
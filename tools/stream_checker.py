@@ -0,0 +1,155 @@
+import json
+
+
+class StreamChecker:
+    # 流式响应的增量解析：边接收边检查段落编号、重复和长度，确定失败时尽早中断
+    def __init__(self, origin_content: list[str], dict_fmt: bool = True, repeat_check: bool = True,
+                 growth_limit: int = 8, growth_slack: int = 200):
+        self.origin_content = origin_content
+        self.dict_fmt = dict_fmt
+        self.repeat_check = repeat_check
+        self.source_rp = len(origin_content) - len(set(origin_content))
+        # 译文长度超过原文的growth_limit倍再加上growth_slack个字符，视为失控
+        self.growth_limit = growth_limit
+        self.growth_slack = growth_slack
+        self.total_limit = growth_limit * sum(len(para) for para in origin_content) + growth_slack
+        self.total_len = 0
+        self.values: list[str] = []
+        # 已经完整接收的 {段落编号: 译文}，JSON格式下是未转义的原始字符串
+        self.pairs: dict[str, str] = {}
+        self.value_set: set[str] = set()
+        self.keys: set[str] = set()
+        self.valid_keys = {str(i + 1) for i in range(len(origin_content))}
+        self.error = ''
+        # JSON扫描状态，遇到无法判断的格式时停止检查，交给完整解析处理
+        self.state = 'start'
+        self.quote = ''
+        self.escape = False
+        self.buffer: list[str] = []
+        self.current_key = ''
+        self.line = ''
+
+    def feed(self, text: str) -> bool:
+        # 返回False表示响应已经确定失败，原因见self.error
+        if self.error:
+            return False
+        self.total_len += len(text)
+        if self.total_len > self.total_limit:
+            return self.fail(f"The response is much longer than the original ({self.total_len} characters).")
+        if self.dict_fmt:
+            for char in text:
+                if self.state == 'unknown' or not self.feed_json(char):
+                    break
+        else:
+            self.feed_lines(text)
+        return not self.error
+
+    def parsed(self) -> dict[str, str]:
+        # 中断前收到的段落，失败后用来保留其中可用的译文
+        if not self.dict_fmt:
+            return dict(self.pairs)
+        result = {}
+        for key, text in self.pairs.items():
+            try:
+                result[key] = json.loads(f'"{text}"') if self.quote == '"' else text
+            except ValueError:
+                pass
+        return result
+
+    def fail(self, reason: str) -> bool:
+        self.error = reason
+        return False
+
+    def add_value(self, value: str):
+        # 译文的重复数只增不减，超过原文的重复数时完整检查必然失败
+        if self.repeat_check:
+            if value in self.value_set and len(self.values) - len(self.value_set) + 1 > self.source_rp:
+                self.fail(f"Unnecessary repeat in the translation: {value[:50]}")
+            self.value_set.add(value)
+        self.values.append(value)
+
+    def value_limit(self, para_idx: int) -> int:
+        if 0 <= para_idx < len(self.origin_content):
+            return self.growth_limit * len(self.origin_content[para_idx]) + self.growth_slack
+        return self.total_limit
+
+    def feed_lines(self, text: str):
+        lines = (self.line + text).split('\n')
+        self.line = lines.pop()
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.strip() in ('<!--start-output-->', '<!--end-output-->'):
+                continue
+            if len(self.values) >= len(self.origin_content):
+                self.fail("The translation contains more lines than the original.")
+                return
+            self.pairs[str(len(self.values) + 1)] = line
+            self.add_value(line)
+            if self.error:
+                return
+        if len(self.line) > self.value_limit(len(self.values)):
+            self.fail(f"Line {len(self.values) + 1} of the translation keeps growing.")
+
+    def feed_json(self, char: str) -> bool:
+        state = self.state
+        if state in ('key', 'value'):
+            if self.escape:
+                self.escape = False
+                self.buffer.append(char)
+            elif char == '\\':
+                self.escape = True
+                self.buffer.append(char)
+            elif char == self.quote:
+                return self.end_string()
+            else:
+                self.buffer.append(char)
+                if state == 'value' and len(self.buffer) > self.value_limit(self.key_index()):
+                    return self.fail(f"Paragraph {self.current_key} of the translation keeps growing.")
+            return True
+        if char.isspace():
+            return True
+        if state == 'start':
+            # 跳过 <!--start-output--> 等前缀，直到对象开始
+            if char == '{':
+                self.state = 'before_key'
+            return True
+        if state == 'before_key' and char in '"\'':
+            self.state, self.quote, self.buffer = 'key', char, []
+        elif state == 'before_key' and char == '}':
+            self.state = 'end'
+        elif state == 'after_key' and char == ':':
+            self.state = 'before_value'
+        elif state == 'before_value' and char in '"\'':
+            self.state, self.quote, self.buffer = 'value', char, []
+        elif state == 'after_value' and char == ',':
+            self.state = 'before_key'
+        elif state == 'after_value' and char == '}':
+            self.state = 'end'
+        elif state == 'end':
+            return True
+        else:
+            self.state = 'unknown'
+        return True
+
+    def key_index(self) -> int:
+        return int(self.current_key) - 1 if self.current_key in self.valid_keys else -1
+
+    def end_string(self) -> bool:
+        text = ''.join(self.buffer)
+        if self.state == 'key':
+            self.state = 'after_key'
+            self.current_key = text
+            # 多出来的键在完整检查时必然导致行数超出原文
+            if text not in self.valid_keys:
+                self.pairs[text] = ''
+                return self.fail(f"The translation contains paragraph {text[:50]} which is not in the original.")
+            if text in self.keys:
+                # 重复的键解析时会被覆盖，是否失败无法提前判断
+                self.state = 'unknown'
+                return False
+            self.keys.add(text)
+            return True
+        self.state = 'after_value'
+        self.pairs[self.current_key] = text
+        self.add_value(text)
+        return not self.error
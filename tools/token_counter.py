@@ -0,0 +1,139 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import regex
+import tiktoken
+
+
+class TokenCounter:
+    # 按模型选择编码器，未知模型（包括非官方模型）使用默认编码
+    default_model_encodings = {
+        'gpt-4': 'cl100k_base',
+        'gpt-3.5-turbo': 'cl100k_base',
+    }
+
+    def __init__(self, encoding_name: str = "cl100k_base", max_size: int = 65536):
+        self.encoding_name = encoding_name
+        self.max_size = max_size
+        self.encoder: tiktoken.Encoding | None = None
+        self.pattern = None
+        self.cache: OrderedDict[bytes, int] = OrderedDict()
+        self.lock = threading.Lock()
+        self.model_encodings = dict(self.default_model_encodings)
+
+    @property
+    def enc(self) -> tiktoken.Encoding:
+        # 第一次用到时才加载编码器，完全命中缓存的任务不需要加载
+        if self.encoder is None:
+            with self.lock:
+                if self.encoder is None:
+                    encoder = tiktoken.get_encoding(self.encoding_name)
+                    # 与编码器相同的预分词规则，BPE只会在预分词片段内部合并
+                    self.pattern = regex.compile(encoder._pat_str)
+                    self.encoder = encoder
+        return self.encoder
+
+    def load_pattern(self):
+        if self.encoder is None:
+            self.enc
+        return self.pattern
+
+    def encoding_for_model(self, model: str) -> str:
+        for prefix in sorted(self.model_encodings, key=len, reverse=True):
+            if model == prefix or model.startswith(prefix + '-'):
+                return self.model_encodings[prefix]
+        try:
+            from tiktoken.model import MODEL_TO_ENCODING, MODEL_PREFIX_TO_ENCODING
+        except ImportError:
+            return self.encoding_name
+        if model in MODEL_TO_ENCODING:
+            return MODEL_TO_ENCODING[model]
+        for prefix, name in MODEL_PREFIX_TO_ENCODING.items():
+            if model.startswith(prefix):
+                return name
+        return self.encoding_name
+
+    def set_model(self, model: str):
+        encoding_name = self.encoding_for_model(model)
+        if encoding_name != self.encoding_name:
+            with self.lock:
+                self.encoding_name = encoding_name
+                self.encoder = None
+                self.pattern = None
+                self.cache.clear()
+
+    @staticmethod
+    def text_key(text: str) -> bytes:
+        return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    def lookup(self, key: bytes) -> int | None:
+        with self.lock:
+            num = self.cache.get(key)
+            if num is not None:
+                self.cache.move_to_end(key)
+            return num
+
+    def remember(self, key: bytes, num: int):
+        with self.lock:
+            self.cache[key] = num
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+    def count(self, text: str) -> int:
+        key = self.text_key(text)
+        num = self.lookup(key)
+        if num is None:
+            num = len(self.enc.encode(text))
+            self.remember(key, num)
+        return num
+
+    def count_batch(self, texts: list[str]) -> list[int]:
+        keys = [self.text_key(text) for text in texts]
+        nums = [self.lookup(key) for key in keys]
+        missing = {}
+        for idx, num in enumerate(nums):
+            if num is None:
+                missing.setdefault(keys[idx], []).append(idx)
+        if missing:
+            miss_texts = [texts[idxs[0]] for idxs in missing.values()]
+            encoded = self.enc.encode_batch(miss_texts)
+            for (key, idxs), tokens in zip(missing.items(), encoded):
+                self.remember(key, len(tokens))
+                for idx in idxs:
+                    nums[idx] = len(tokens)
+        return nums
+
+    def join_cost(self, left: str, right: str, sep: str) -> int:
+        # 计算 left + sep + right 比两段单独编码多出的token数，只重新编码拼接处附近的片段
+        pattern = self.load_pattern()
+        left_pieces = pattern.findall(left)
+        lead = left_pieces[-1] if left_pieces else ''
+        right_starts = set()
+        right_pieces = []
+        pos = 0
+        for match in pattern.finditer(right):
+            right_starts.add(match.start())
+            right_pieces.append(match.group())
+            pos = match.end()
+        right_starts.add(pos)
+
+        # 拼接后从某个片段起点重新对齐时，后面的切分与单独编码时完全一致
+        offset = len(lead) + len(sep)
+        window_pieces = []
+        synced_at = len(right)
+        for match in pattern.finditer(lead + sep + right):
+            if match.start() >= offset and match.start() - offset in right_starts:
+                synced_at = match.start() - offset
+                break
+            window_pieces.append(match.group())
+
+        consumed = 0
+        replaced = 0
+        for piece in right_pieces:
+            if consumed >= synced_at:
+                break
+            replaced += self.count(piece)
+            consumed += len(piece)
+        return sum(self.count(piece) for piece in window_pieces) - self.count(lead) - replaced
@@ -0,0 +1,140 @@
+import hashlib
+import struct
+import unicodedata
+import zlib
+from sqlite3 import Connection
+
+from tools.cache_base import add_column, decode_payload
+
+# 单次置换MinHash：每个片段只哈希一次，按哈希值分到各个桶里取最小值
+NGRAM = 3
+BANDS = 8
+BAND_ROWS = 6
+NUM_BINS = BANDS * BAND_ROWS
+# 太短的段落相似度没有意义，不做模糊匹配
+MIN_LENGTH = 8
+MAX_CANDIDATES = 8
+
+
+def normalize(text: str) -> str:
+    return " ".join(unicodedata.normalize('NFKC', text).casefold().split())
+
+
+def trivial_key(text: str) -> str:
+    # 去掉标点、空白和符号后相同的段落视为只有微小改动，可以直接复用译文
+    return "".join(char for char in normalize(text) if unicodedata.category(char)[0] not in 'PZSC')
+
+
+def shingles(text: str) -> set[str]:
+    text = normalize(text)
+    if len(text) <= NGRAM:
+        return {text}
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+def similarity(left: str | set[str], right: str | set[str]) -> float:
+    left = shingles(left) if isinstance(left, str) else left
+    right = shingles(right) if isinstance(right, str) else right
+    if not left or not right:
+        return 0.0
+    return len(left & right) / len(left | right)
+
+
+def signature(grams: set[str]) -> list[int]:
+    bins = [-1] * NUM_BINS
+    for gram in grams:
+        value = zlib.crc32(gram.encode('utf-8'))
+        idx = value % NUM_BINS
+        value //= NUM_BINS
+        if bins[idx] < 0 or value < bins[idx]:
+            bins[idx] = value
+    # 空桶借用后面第一个非空桶的值，并加上距离区分来源
+    filled = [idx for idx in range(NUM_BINS) if bins[idx] >= 0]
+    if not filled:
+        return bins
+    for idx in range(NUM_BINS):
+        if bins[idx] < 0:
+            offset = 1
+            while bins[(idx + offset) % NUM_BINS] < 0:
+                offset += 1
+            bins[idx] = bins[(idx + offset) % NUM_BINS] + (offset << 32)
+    return bins
+
+
+def band_keys(sig: list[int]) -> list[int]:
+    keys = []
+    for band in range(BANDS):
+        rows = sig[band * BAND_ROWS:(band + 1) * BAND_ROWS]
+        digest = hashlib.blake2b(struct.pack(f'<{BAND_ROWS + 1}q', band, *rows), digest_size=8).digest()
+        keys.append(struct.unpack('<q', digest)[0])
+    return keys
+
+
+def create_tm_table(conn: Connection):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS tm_index
+                (bucket INTEGER,
+                para_id INTEGER,
+                PRIMARY KEY (bucket, para_id)) WITHOUT ROWID''')
+    add_column(conn, 'para_cache', 'tm_indexed', 'INTEGER DEFAULT 0')
+    c.execute('''CREATE INDEX IF NOT EXISTS para_cache_tm ON para_cache (id) WHERE tm_indexed=0''')
+    conn.commit()
+
+
+def index_paras(conn: Connection, commit=True) -> int:
+    # 把还没建索引的段落缓存加入LSH索引，新写入的段落在同一事务里增量加入
+    read = conn.cursor()
+    c = conn.cursor()
+    indexed = 0
+    read.execute('''SELECT id, original FROM para_cache WHERE tm_indexed=0''')
+    while rows := read.fetchmany(1000):
+        buckets = []
+        for row_id, original in rows:
+            original = decode_payload(original) or ''
+            if len(normalize(original)) >= MIN_LENGTH:
+                buckets += [(key, row_id) for key in band_keys(signature(shingles(original)))]
+        c.executemany('''INSERT OR IGNORE INTO tm_index (bucket, para_id) VALUES (?, ?)''', buckets)
+        c.executemany('''UPDATE para_cache SET tm_indexed=1 WHERE id=?''', [(row[0],) for row in rows])
+        indexed += len(rows)
+    if commit:
+        conn.commit()
+    return indexed
+
+
+def prune_index(conn: Connection, commit=True):
+    # 段落缓存被淘汰后删除对应的索引
+    c = conn.cursor()
+    if c.execute('''SELECT name FROM sqlite_master WHERE type='table' AND name='tm_index' ''').fetchone():
+        c.execute('''DELETE FROM tm_index WHERE para_id NOT IN (SELECT id FROM para_cache)''')
+    if commit:
+        conn.commit()
+
+
+def lookup_tm(conn: Connection, target_lang: str, engine: str, model: str, paras: list[str],
+              threshold: float) -> dict[str, tuple[float, str, str]]:
+    # 返回 {段落: (相似度, 缓存原文, 缓存译文)}，相似度为1表示只有标点空白等微小改动
+    found = {}
+    c = conn.cursor()
+    for para in dict.fromkeys(paras):
+        if len(normalize(para)) < MIN_LENGTH:
+            continue
+        grams = shingles(para)
+        keys = band_keys(signature(grams))
+        # 同一个缓存文件里可能有其它语言或模型的段落，先按目标语言和模型过滤再取命中桶数最多的候选
+        c.execute(f'''SELECT p.original, p.trans FROM tm_index t JOIN para_cache p ON p.id = t.para_id
+                        WHERE t.bucket IN ({", ".join("?" * len(keys))}) AND p.target=? AND p.engine=? AND p.model=?
+                        GROUP BY p.id ORDER BY COUNT(*) DESC LIMIT {MAX_CANDIDATES}''',
+                  (*keys, target_lang, engine, model))
+        key = trivial_key(para)
+        best = None
+        for original, trans in c.fetchall():
+            original = decode_payload(original)
+            if key and trivial_key(original) == key:
+                best = (1.0, original, decode_payload(trans))
+                break
+            score = similarity(grams, original)
+            if score >= threshold and (best is None or score > best[0]):
+                best = (score, original, decode_payload(trans))
+        if best is not None:
+            found[para] = best
+    return found